@@ -0,0 +1,414 @@
+"""
+Description: thermal statistics for the live view. The minimum, maximum, mean and the hottest point of the
+thermal frame are found on a small downsampled copy of the frame (an image pyramid whose buffers are kept
+between frames) and only the area around the hottest and coldest candidates is searched again at full
+resolution. The results are drawn on the fused view and can be streamed to a CSV file.
+
+The same file holds the smoothed thermal histogram which drives the automatic ThermaVue threshold and the
+automatic gain control (contrast stretch) of the thermal stream, and the change detector which starts and
+stops the recording in the "On change" recording modes.
+
+WarmObjectDetector finds the warm objects (connected areas of warm pixels) of the thermal frame on a downsampled
+mask every few frames and follows them in between, and ObjectLog streams them to a CSV file.
+
+Y16Mapper maps the raw 16 bit frames of radiometric thermal cameras to the 8 bit frames of the pipeline, and
+celsius() turns raw values into temperatures.
+
+"""
+
+import csv
+import time
+from collections import deque, namedtuple
+import cv2
+import numpy as np
+
+# The unit is "C" when the values are temperatures read from a raw 16 bit frame, empty for 8 bit intensities
+ThermalStats = namedtuple("ThermalStats", ["min", "max", "mean", "hotspot", "coldspot", "unit"], defaults = [""])
+# A warm object in frame coordinates: box is (x, y, width, height), area is in pixels of the frame
+WarmObject = namedtuple("WarmObject", ["id", "box", "area", "centroid"])
+
+
+def celsius(raw, calibration):
+    '''Converts raw values of a 16 bit thermal frame to degrees Celsius.
+    Input: a raw value or array, and the calibration coefficients of the camera, highest power first
+    (e.g. [0.01, -273.15] for cameras which count in hundredths of a kelvin).
+    '''
+    return np.polyval(calibration, raw)
+
+
+class ThermalAnalytics:
+    def __init__(self, levels = 3):
+        '''Initialises the analytics. Every pyramid level halves the frame, so 3 levels turn 640x480 into 80x60.
+        '''
+        self.levels = levels
+        self.pyramid = []
+
+    def build_pyramid(self, gray):
+        '''Downsamples a single channel thermal frame into the cached pyramid buffers. The buffers are only
+        allocated again when the frame size changes.
+        Returns: the smallest level.
+        '''
+        h, w = gray.shape[:2]
+        if (not self.pyramid or self.pyramid[0].shape != ((h + 1) // 2, (w + 1) // 2)
+                or self.pyramid[0].dtype != gray.dtype):
+            self.pyramid = []
+            for _ in range(self.levels):
+                h, w = (h + 1) // 2, (w + 1) // 2
+                self.pyramid.append(np.empty((h, w), gray.dtype))
+
+        level = gray
+        for buffer in self.pyramid:
+            cv2.pyrDown(level, dst = buffer)
+            level = buffer
+        return level
+
+    def refine(self, gray, point):
+        '''Searches the full resolution frame around a point found on the smallest pyramid level.
+        Returns: min value, max value, min location and max location inside that area.
+        '''
+        scale = 2 ** self.levels
+        x, y = point[0] * scale, point[1] * scale
+        h, w = gray.shape[:2]
+        x0, y0 = max(0, x - scale), max(0, y - scale)
+        x1, y1 = min(w, x + 2 * scale), min(h, y + 2 * scale)
+        minVal, maxVal, minLoc, maxLoc = cv2.minMaxLoc(gray[y0:y1, x0:x1])
+        return minVal, maxVal, (minLoc[0] + x0, minLoc[1] + y0), (maxLoc[0] + x0, maxLoc[1] + y0)
+
+    def analyse(self, gray):
+        '''Computes the statistics of a single channel thermal frame.
+        Input: thermal frame (grey, 8 bit, or the raw 16 bit frame).
+        Returns: ThermalStats with min, max, mean and the hottest and coldest points in frame coordinates.
+        '''
+        smallest = self.build_pyramid(gray)
+        _, _, minLoc, maxLoc = cv2.minMaxLoc(smallest)
+        mean = cv2.mean(smallest)[0]
+
+        _, maxVal, _, hotspot = self.refine(gray, maxLoc)
+        minVal, _, coldspot, _ = self.refine(gray, minLoc)
+        return ThermalStats(minVal, maxVal, mean, hotspot, coldspot)
+
+    def draw(self, frame, stats):
+        '''Draws the hottest point and the statistics on the fused frame.
+        '''
+        cv2.drawMarker(frame, stats.hotspot, (255, 255, 255), cv2.MARKER_CROSS, 24, 2)
+        digits = 1 if stats.unit else 0
+        cv2.putText(frame, f"{stats.max:.{digits}f} {stats.unit}", (stats.hotspot[0] + 8, stats.hotspot[1] - 8),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        text = f"min {stats.min:.{digits}f}  max {stats.max:.{digits}f}  mean {stats.mean:.1f} {stats.unit}"
+        cv2.putText(frame, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+
+
+class ThermalHistogram:
+    def __init__(self, smoothing = 0.1):
+        '''Initialises the histogram of the thermal stream. Every new frame only moves the histogram by the
+        smoothing factor, so the threshold and the gain follow the scene without flickering.
+        '''
+        self.smoothing = smoothing
+        self.histogram = None
+        self.lut = None
+        self.lut_window = None
+
+    def update(self, gray):
+        '''Adds a single channel thermal frame to the smoothed histogram. This is the only pass over the frame,
+        the threshold and the gain are both read from the result.
+        '''
+        histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        histogram /= max(histogram.sum(), 1)
+        if self.histogram is None:
+            self.histogram = histogram
+        else:
+            self.histogram += self.smoothing * (histogram - self.histogram)
+
+    def percentile(self, percent):
+        '''Returns the intensity below which the given percentage of the pixels lie.
+        '''
+        cumulative = np.cumsum(self.histogram)
+        return int(min(255, np.searchsorted(cumulative, percent / 100.0 * cumulative[-1])))
+
+    def otsu(self):
+        '''Returns the Otsu threshold of the histogram, the intensity which best splits it into a cold and a
+        warm class.
+        '''
+        histogram = self.histogram.astype(np.float64)
+        weight = np.cumsum(histogram)
+        mean = np.cumsum(histogram * np.arange(256))
+        denominator = weight * (weight[-1] - weight)
+        variance = np.zeros(256)
+        valid = denominator > 1e-9
+        variance[valid] = (mean[-1] * weight[valid] - mean[valid] * weight[-1]) ** 2 / denominator[valid]
+        return int(np.argmax(variance))
+
+    def agc_lut(self, low_percent = 1, high_percent = 99):
+        '''Returns a lookup table which stretches the thermal intensities between the two percentiles over the
+        full 0-255 range. The table is only rebuilt when the percentiles move.
+        '''
+        low = self.percentile(low_percent)
+        high = max(self.percentile(high_percent), low + 1)
+        if self.lut_window != (low, high):
+            levels = np.arange(256, dtype = np.float32)
+            self.lut = np.clip((levels - low) * 255.0 / (high - low), 0, 255).astype(np.uint8)
+            self.lut_window = (low, high)
+        return self.lut
+
+
+class WarmObjectDetector:
+    def __init__(self, interval = 5, scale = 4, min_area = 4, max_objects = 16):
+        '''Initialises the warm object detection. The warm mask is made at 1/scale of the frame size (160x120 for
+        640x480), the objects are searched on the whole mask every interval frames and only followed in between.
+        Areas smaller than min_area pixels of the mask are ignored, and at most max_objects of the largest are kept.
+        '''
+        self.interval = interval
+        self.scale = scale
+        self.min_area = min_area
+        self.max_objects = max_objects
+        self.small = None
+        self.mask = None
+        self.frame = 0
+        self.next_id = 1
+        # The followed objects in mask coordinates: id, box, area, centroid
+        self.tracks = []
+
+    def update(self, gray, threshold):
+        '''Finds or follows the warm objects of a single channel thermal frame. Warm pixels are the ones ThermaVue
+        colours with the same threshold, at least 255 - threshold.
+        Returns: list of WarmObject in frame coordinates, largest first.
+        '''
+        h, w = gray.shape[:2]
+        self.small = cv2.resize(gray, (w // self.scale, h // self.scale), dst = self.small, interpolation = cv2.INTER_AREA)
+        _, self.mask = cv2.threshold(self.small, 254 - threshold, 255, cv2.THRESH_BINARY, dst = self.mask)
+        if self.frame % self.interval == 0:
+            self.detect()
+        else:
+            self.follow()
+        self.frame += 1
+
+        # A mask pixel covers scale x scale frame pixels, its centre lies half a block further
+        scale = self.scale
+        return [WarmObject(track_id, tuple(int(value * scale) for value in box), int(area * scale * scale),
+                           (round((centroid[0] + 0.5) * scale - 0.5), round((centroid[1] + 0.5) * scale - 0.5)))
+                for track_id, box, area, centroid in self.tracks]
+
+    def detect(self):
+        '''Labels the connected warm areas of the whole mask. An area keeps the id of the followed object whose centre
+        is nearest, if that centre lies within the size of the object.
+        '''
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(self.mask, connectivity = 8)
+        found = sorted((label for label in range(1, count) if stats[label, cv2.CC_STAT_AREA] >= self.min_area),
+                       key = lambda label: -stats[label, cv2.CC_STAT_AREA])[:self.max_objects]
+
+        previous = list(self.tracks)
+        self.tracks = []
+        for label in found:
+            centroid = tuple(centroids[label])
+            track_id = None
+            nearest = None
+            for track in previous:
+                distance = max(abs(centroid[0] - track[3][0]), abs(centroid[1] - track[3][1]))
+                if distance <= max(track[1][2], track[1][3]) and (nearest is None or distance < nearest):
+                    track_id, nearest = track[0], distance
+            if track_id is None:
+                track_id = self.next_id
+                self.next_id += 1
+            else:
+                previous = [track for track in previous if track[0] != track_id]
+            self.tracks.append((track_id, tuple(int(value) for value in stats[label, :4]),
+                                int(stats[label, cv2.CC_STAT_AREA]), centroid))
+
+    def follow(self):
+        '''Moves every object to the warm pixels around its last box: the box is searched with a margin of half its
+        size, which only costs a few small areas of the mask per frame. Objects which cooled down or left are dropped.
+        '''
+        mask_h, mask_w = self.mask.shape
+        tracks = []
+        for track_id, (x, y, w, h), _, _ in self.tracks:
+            margin = max(w, h) // 2 + 1
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(mask_w, x + w + margin), min(mask_h, y + h + margin)
+            area = self.mask[y0:y1, x0:x1]
+            moments = cv2.moments(area, binaryImage = True)
+            if moments["m00"] < self.min_area:
+                continue
+            bx, by, bw, bh = cv2.boundingRect(area)
+            box = (bx + x0, by + y0, bw, bh)
+            # Objects which ran into each other are one object until the next detection tells them apart
+            if any(track[1] == box for track in tracks):
+                continue
+            centroid = (moments["m10"] / moments["m00"] + x0, moments["m01"] / moments["m00"] + y0)
+            tracks.append((track_id, box, int(moments["m00"]), centroid))
+        self.tracks = tracks
+
+    def draw(self, frame, objects):
+        '''Draws the box and the id of every warm object and their count on the fused frame.
+        '''
+        for warm_object in objects:
+            x, y, w, h = warm_object.box
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 255, 255), 1, cv2.LINE_AA)
+            cv2.putText(frame, str(warm_object.id), (x + 2, y + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+        text = f"{len(objects)} warm object{'' if len(objects) == 1 else 's'}"
+        cv2.putText(frame, text, (10, frame.shape[0] - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+
+
+class Y16Mapper:
+    def __init__(self, smoothing = 0.1, step = 4):
+        '''Initialises the mapping of raw 16 bit thermal frames to 8 bit. The histogram of the raw values is
+        smoothed like the 8 bit one and is taken from every step-th pixel of every step-th row.
+        '''
+        self.smoothing = smoothing
+        self.step = step
+        self.histogram = None
+        self.lut = None
+        self.lut_window = None
+
+    def update(self, raw):
+        '''Adds a raw 16 bit frame to the smoothed histogram of the raw values.
+        '''
+        sample = np.ascontiguousarray(raw[::self.step, ::self.step])
+        histogram = cv2.calcHist([sample], [0], None, [65536], [0, 65536]).ravel()
+        histogram /= max(histogram.sum(), 1)
+        if self.histogram is None:
+            self.histogram = histogram
+        else:
+            self.histogram += self.smoothing * (histogram - self.histogram)
+
+    def window(self, low_percent, high_percent):
+        '''Returns the raw values below which the two given percentages of the pixels lie.
+        '''
+        cumulative = np.cumsum(self.histogram)
+        low = int(min(np.searchsorted(cumulative, low_percent / 100.0 * cumulative[-1], side = "right"), 65534))
+        high = int(np.searchsorted(cumulative, high_percent / 100.0 * cumulative[-1]))
+        return low, min(max(high, low + 1), 65535)
+
+    def map(self, raw, agc = True):
+        '''Maps a raw 16 bit frame to 8 bit with a 65536 entry lookup table, one lookup per pixel. With the gain
+        on, the values between the 1st and 99th percentile are stretched over the 0-255 range, otherwise nearly the
+        whole range of the scene is (0.1th to 99.9th percentile, so a few dead pixels do not flatten the picture). The table is only rebuilt when the window moves by more than one grey level.
+        Returns: the 8 bit thermal frame.
+        '''
+        self.update(raw)
+        low, high = self.window(1, 99) if agc else self.window(0.1, 99.9)
+        if self.lut_window is not None:
+            tolerance = (self.lut_window[1] - self.lut_window[0]) / 256.0
+            if abs(low - self.lut_window[0]) <= tolerance and abs(high - self.lut_window[1]) <= tolerance:
+                low, high = self.lut_window
+        if self.lut_window != (low, high):
+            levels = np.arange(65536, dtype = np.float32)
+            self.lut = np.clip((levels - low) * 255.0 / (high - low), 0, 255).astype(np.uint8)
+            self.lut_window = (low, high)
+        return np.take(self.lut, raw)
+
+
+class ThermalChangeDetector:
+    def __init__(self, size = (80, 60), adaptation = 0.05, min_changed = 0.005):
+        '''Notices when the thermal scene changes, by comparing a small downsampled copy of every thermal frame
+        with a slowly updated background. Slow drifts of the whole scene are absorbed by the background.
+        Input: size of the downsampled frame, how fast the background follows the scene (0-1) and the part of the
+        pixels which has to change for the frame to count as changed.
+        '''
+        self.size = size
+        self.adaptation = adaptation
+        self.min_changed = min_changed
+        self.small = None
+        self.background = None
+        self.difference = np.empty(size[::-1], np.float32)
+        self.last_change = 0.0
+
+    def reset(self):
+        '''Forgets the background, e.g. when the detection is switched on again after a while, so the first frame
+        is not compared with an old scene. The next frame becomes the background.
+        '''
+        self.background = None
+
+    def update(self, gray, sensitivity = 50, unit = 1.0):
+        '''Compares one single channel thermal frame, 8 bit or raw 16 bit, with the background.
+        Input: the thermal frame, the sensitivity (0-100), a higher sensitivity reacts to smaller temperature changes,
+        and the size in frame values of one step of the 8 bit scale, for raw frames.
+        Returns: the time of the last change, time.time() if this frame changed.
+        '''
+        if self.small is None or self.small.dtype != gray.dtype:
+            self.small = np.empty(self.size[::-1], gray.dtype)
+            self.background = None
+        cv2.resize(gray, self.size, dst = self.small, interpolation = cv2.INTER_AREA)
+        small = self.small.astype(np.float32)
+        if self.background is None:
+            self.background = small
+            return self.last_change
+
+        cv2.absdiff(small, self.background, dst = self.difference)
+        level = (4 + (100 - min(max(sensitivity, 0), 100)) * 0.6) * unit
+        changed = np.count_nonzero(self.difference > level)
+        if changed >= self.min_changed * self.difference.size:
+            self.last_change = time.time()
+        cv2.accumulateWeighted(small, self.background, self.adaptation)
+        return self.last_change
+
+
+class ChangeGate:
+    def __init__(self, pre = 2, post = 3, fps = 24):
+        '''Picks the frames of a recording which only keeps the moments when the thermal scene changes. The last
+        pre seconds before a change are held back in memory, and frames are kept until post seconds after the last change.
+        '''
+        self.post = post
+        self.held = deque(maxlen = max(1, int(pre * fps)))
+
+    def push(self, frame, timestamp, last_change):
+        '''Offers one frame of the recording.
+        Returns: list of (frame, timestamp) to write now, empty while nothing is changing.
+        '''
+        self.held.append((frame, timestamp))
+        if timestamp - last_change > self.post:
+            return []
+        frames = list(self.held)
+        self.held.clear()
+        return frames
+
+
+class StatsLog:
+    def __init__(self, path):
+        '''Opens a CSV file for the statistics. Rows are buffered and written to disk once per second.
+        '''
+        self.path = path
+        self.file = open(path, "w", newline = "")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["time", "min", "max", "mean", "hotspot_x", "hotspot_y"])
+        self.last_flush = time.time()
+
+    def write(self, stats):
+        '''Adds one row of statistics to the file.
+        '''
+        now = time.time()
+        digits = 2 if stats.unit else 0
+        self.writer.writerow([f"{now:.3f}", f"{stats.min:.{digits}f}", f"{stats.max:.{digits}f}", f"{stats.mean:.2f}",
+                              stats.hotspot[0], stats.hotspot[1]])
+        if now - self.last_flush > 1:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+
+class ObjectLog:
+    def __init__(self, path):
+        '''Opens a CSV file for the warm objects, one row per object and frame. Rows are written to disk once per second.
+        '''
+        self.path = path
+        self.file = open(path, "w", newline = "")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["time", "count", "id", "x", "y", "width", "height", "area", "centroid_x", "centroid_y"])
+        self.last_flush = time.time()
+
+    def write(self, objects):
+        '''Adds the warm objects of one frame to the file, or a row with a count of 0 when there are none.
+        '''
+        now = time.time()
+        if not objects:
+            self.writer.writerow([f"{now:.3f}", 0] + [""] * 8)
+        for warm_object in objects:
+            self.writer.writerow([f"{now:.3f}", len(objects), warm_object.id, *warm_object.box, warm_object.area,
+                                  *warm_object.centroid])
+        if now - self.last_flush > 1:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
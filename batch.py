@@ -0,0 +1,273 @@
+"""
+Description: fusion of whole stacks of frames, for re-fusing recorded camera footage offline. The kernels take
+(N, H, W, C) or (N, H, W) arrays and give the same results as the per-frame methods of FusionPipeline. A chunk is
+fused as many frames at a time as keep the frames between the stages in the processor cache (a sub-chunk), and the
+stacks are reused from one sub-chunk to the next instead of being allocated again. Per-pixel operations run on the
+sub-chunk as one tall image; stages which have no batch kernel, because they are faster that way, run frame by frame.
+
+Run "python batch.py visible.mp4 thermal.mp4 fused.mp4" with the flags of the wanted mode (see --help) to
+re-fuse a pair of camera recordings.
+
+"""
+
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+import variables
+from fusion import FusionPipeline, STAGES, THRESHOLD_MODES, JET_RGB_SMOOTH
+
+
+def tall(frames):
+    '''Views a stack of frames as one image with the frames below each other.
+    '''
+    return frames.reshape((-1,) + frames.shape[2:])
+
+
+def tallOut(out):
+    return None if out is None else tall(out)
+
+
+def toRGBBatch(batch, frames, out = None):
+    return cv2.cvtColor(tall(frames), cv2.COLOR_GRAY2RGB, dst = tallOut(out)).reshape(frames.shape + (3,))
+
+
+def blendFramesBatch(batch, frames1, frames2, opacity, out = None):
+    fused = cv2.addWeighted(tall(frames1), 1 - opacity / 100.0, tall(frames2), opacity / 100.0, 0, dst = tallOut(out))
+    return fused.reshape(frames1.shape)
+
+
+def blendLuminanceBatch(batch, visibleFrames, termoFrames, opacity, out = None):
+    '''FusionPipeline.blendLuminance on a stack of frames.
+    '''
+    ycrcbFrames = cv2.cvtColor(tall(visibleFrames), cv2.COLOR_RGB2YCrCb, dst = tall(batch.buffer("ycrcb", visibleFrames.shape, np.uint8)))
+    luminance = cv2.extractChannel(ycrcbFrames, 0, dst = tall(batch.buffer("luminance", termoFrames.shape, np.uint8)))
+    cv2.addWeighted(luminance, 1 - opacity / 100.0, tall(termoFrames), opacity / 100.0, 0, dst = luminance)
+    cv2.insertChannel(luminance, ycrcbFrames, 0)
+    return cv2.cvtColor(ycrcbFrames, cv2.COLOR_YCrCb2RGB, dst = tallOut(out)).reshape(visibleFrames.shape)
+
+
+def thermaVueBatch(batch, visibleFrames, termoFrames, thresholds, out = None):
+    '''FusionPipeline.thermaVue on a stack of frames, with one threshold per frame.
+    '''
+    bwFrames = batch.buffer("bw", termoFrames.shape, np.uint8)
+    cv2.bitwise_not(tall(termoFrames), dst = tall(bwFrames))
+    # Keeps the pixels at or below the threshold and blacks out the rest, like pureThermalOnVisible
+    for bwFrame, threshold in zip(bwFrames, thresholds):
+        cv2.threshold(bwFrame, int(threshold), 255, cv2.THRESH_TOZERO_INV, dst = bwFrame)
+    coloredObjects = cv2.applyColorMap(tall(bwFrames), JET_RGB_SMOOTH, dst = tall(batch.buffer("colored", visibleFrames.shape, np.uint8)))
+    cv2.add(tall(visibleFrames), coloredObjects, dst = coloredObjects)
+    return cv2.cvtColor(coloredObjects, cv2.COLOR_RGB2BGR, dst = tallOut(out)).reshape(visibleFrames.shape)
+
+
+# Batch kernels of the built-in stages, by stage name. Only the per-pixel stages gain from running on a stack; the
+# filters (contours, colour map) and the pyramid are faster frame by frame, their borders between the frames of a
+# tall image have to be filtered again
+BATCH_KERNELS = {
+    "termoRGB": toRGBBatch,
+    "thermaVue": thermaVueBatch,
+    "blendLuminance": blendLuminanceBatch,
+    "blend": blendFramesBatch,
+    "blendMap": blendFramesBatch,
+    "blendVisibleContour": blendFramesBatch,
+    "blendVisibleContourMap": blendFramesBatch,
+    "blendTermoContour": blendFramesBatch,
+    "blendContours": blendFramesBatch,
+}
+
+# Bytes a frame needs while it goes through the stages: the prepared frames and a few 640x480 RGB frames in between
+FRAME_WORKING_SET = 4 * 640 * 480 * 3
+
+
+def sub_chunk_size():
+    '''Frames which go through the stages together: as many as keep the frames between the stages in the level 2
+    cache of the processor, those of a whole chunk would not fit. One frame where the cache size is unknown.
+    '''
+    try:
+        with open("/sys/devices/system/cpu/cpu0/cache/index2/size") as file:
+            text = file.read().strip().upper()
+        cache = int(text.rstrip("KM")) * (2 ** 20 if text.endswith("M") else 2 ** 10 if text.endswith("K") else 1)
+    except (OSError, ValueError):
+        return 1
+    return max(1, cache // FRAME_WORKING_SET)
+
+
+class BatchFusion:
+    def __init__(self, settings, sub_chunk = None):
+        '''Fuses stacks of frames with the flags of the settings, picking the stages the same way the live pipeline does.
+        The frames of a chunk go through the stages sub_chunk frames at a time, by default as many as fit in the cache.
+        '''
+        self.settings = settings
+        self.sub_chunk = sub_chunk or sub_chunk_size()
+        self.pipeline = FusionPipeline(settings)
+        self.stage_times = {}
+        # Reused buffers for one sub-chunk: the prepared frames, the output of every stage and the frames within the
+        # kernels, by name. The fused frames of a whole chunk are kept apart
+        self.buffers = {}
+        self.fused = None
+
+    def buffer(self, name, shape, dtype):
+        '''Returns a reused buffer for a stack of frames.
+        '''
+        buffer = self.buffers.get(name)
+        if buffer is None or len(buffer) < shape[0] or buffer.shape[1:] != shape[1:] or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer[:shape[0]]
+
+    def prepareFrames(self, visibleFrames, termoFrames):
+        '''Prepares every pair of frames like the live pipeline (flip, resize, gain and threshold), straight into
+        the reused stacks. The gain and the automatic threshold follow the scene from frame to frame, so this part
+        runs in order.
+        Returns: stacks of visible and thermal frames, which are reused by the next call, and the thresholds.
+        '''
+        count = len(visibleFrames)
+        visibleStack = self.buffer("visible", (count, 480, 640, 3), np.uint8)
+        termoStack = self.buffer("termo", (count, 480, 640), np.uint8)
+        thresholds = []
+        for i, (visibleFrame, termoFrame) in enumerate(zip(visibleFrames, termoFrames)):
+            visibleFrame, termoFrame, threshold, _ = self.pipeline.prepareFrames(visibleFrame, termoFrame, visibleStack[i], termoStack[i])
+            # Raw 16 bit frames are mapped to a new 8 bit frame
+            if not np.may_share_memory(termoFrame, termoStack):
+                termoStack[i] = termoFrame
+            thresholds.append(threshold)
+        return visibleStack, termoStack, np.array(thresholds)
+
+    def runFrames(self, stage, inputs, kwargs, out):
+        '''Runs a stage which has no batch kernel frame by frame, into out if it is given.
+        '''
+        for i in range(len(inputs[0])):
+            frame_kwargs = dict(kwargs, out = out[i]) if stage.preallocate and out is not None else kwargs
+            frame = stage.function(self.pipeline, *[stack[i] for stack in inputs], **frame_kwargs)
+            if out is None:
+                out = np.empty((len(inputs[0]),) + frame.shape, frame.dtype)
+            if not np.may_share_memory(frame, out):
+                out[i] = frame
+        return out
+
+    def runStage(self, name, frames, out = None):
+        '''FusionPipeline.runStage for stacks of frames, into out if it is given and otherwise into the reused
+        buffer of the stage. Stages without a batch kernel run frame by frame.
+        '''
+        if name in frames:
+            return frames[name]
+        for stage in STAGES:
+            if stage.output == name and (stage.when is None or stage.when(self.settings)):
+                break
+        else:
+            raise KeyError(f"No fusion stage makes the {name} frame")
+
+        inputs = [self.runStage(input_name, frames) for input_name in stage.inputs]
+        kwargs = {setting: getattr(self.settings, setting) for setting in stage.settings}
+        count = len(inputs[0])
+        if out is None and stage.name in self.buffers and len(self.buffers[stage.name]) >= count:
+            out = self.buffers[stage.name][:count]
+
+        start = time.perf_counter()
+        if stage.name in BATCH_KERNELS:
+            result = BATCH_KERNELS[stage.name](self, *inputs, out = out, **kwargs)
+        else:
+            result = self.runFrames(stage, inputs, kwargs, out)
+        if out is None:
+            # The first sub-chunk gives the buffer of the stage for the following ones
+            self.buffers[stage.name] = result
+        elif not np.may_share_memory(result, out):
+            out[...] = result
+            result = out
+        self.stage_times[stage.name] = self.stage_times.get(stage.name, 0) + (time.perf_counter() - start) * 1000
+
+        frames[name] = result
+        return result
+
+    def fuse(self, visibleFrames, termoFrames):
+        '''Fuses a chunk of camera frames, a few frames (a sub-chunk) at a time.
+        Input: lists or stacks of visible and thermal frames as read from the cameras or video files.
+        Returns: (N, 480, 640, 3) stack of fused frames in the channel order of the pipeline, reused by the next call.
+        '''
+        count = min(len(visibleFrames), len(termoFrames))
+        for start in range(0, count, self.sub_chunk):
+            end = min(start + self.sub_chunk, count)
+            visibleStack, termoStack, thresholds = self.prepareFrames(visibleFrames[start:end], termoFrames[start:end])
+            frames = {"visible": visibleStack, "termo": termoStack, "threshold": thresholds}
+            out = self.fused[start:end] if self.fused is not None and len(self.fused) >= count else None
+            fused = self.runStage("fused", frames, out)
+            if out is None:
+                if start == 0:
+                    self.fused = np.empty((count,) + fused.shape[1:], fused.dtype)
+                self.fused[start:end] = fused
+        return self.fused[:count]
+
+
+def read_chunk(capture, size):
+    frames = []
+    while len(frames) < size:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    return frames
+
+
+def reprocess(visible_path, thermal_path, output_path, settings, chunk = 32, sub_chunk = None):
+    '''Re-fuses a visible and a thermal recording chunk by chunk and writes the fused video.
+    Returns: the number of frames written.
+    '''
+    visible = cv2.VideoCapture(visible_path)
+    thermal = cv2.VideoCapture(thermal_path)
+    fps = visible.get(cv2.CAP_PROP_FPS) or 24
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (640, 480))
+    fusion = BatchFusion(settings, sub_chunk)
+
+    count = 0
+    while True:
+        visibleFrames = read_chunk(visible, chunk)
+        termoFrames = read_chunk(thermal, len(visibleFrames))
+        size = min(len(visibleFrames), len(termoFrames))
+        if size == 0:
+            break
+        fusedFrames = fusion.fuse(visibleFrames[:size], termoFrames[:size])
+        # The video shows the frames the way the live view does, the encoder takes BGR
+        for fusedFrame in fusedFrames:
+            writer.write(cv2.cvtColor(fusedFrame, cv2.COLOR_RGB2BGR))
+        count += size
+
+    visible.release()
+    thermal.release()
+    writer.release()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Re-fuse a visible and a thermal recording.")
+    parser.add_argument("visible", help = "recording of the visible camera")
+    parser.add_argument("thermal", help = "recording of the thermal camera")
+    parser.add_argument("output", help = "fused video to write (mp4)")
+    parser.add_argument("--contour-thermo", action = "store_true")
+    parser.add_argument("--contour-visible", action = "store_true")
+    parser.add_argument("--color-map", action = "store_true")
+    parser.add_argument("--thermavue", action = "store_true")
+    parser.add_argument("--luminance", action = "store_true", help = "blend the thermal frame into the visible luminance only")
+    parser.add_argument("--pyramid", action = "store_true", help = "fuse the thermal frame into the visible luminance scale by scale")
+    parser.add_argument("--auto-gain", action = "store_true")
+    parser.add_argument("--threshold", choices = THRESHOLD_MODES, default = "Fixed")
+    parser.add_argument("--opacity", type = int, default = 50)
+    parser.add_argument("--chunk", type = int, default = 32, help = "frames read and fused at once")
+    parser.add_argument("--sub-chunk", type = int, help = "frames which go through the stages together (default: as many as fit in the cache)")
+    args = parser.parse_args()
+
+    settings = variables.PairSettings()
+    settings.termo_flag = args.contour_thermo
+    settings.visible_flag = args.contour_visible
+    settings.map_flag = args.color_map
+    settings.vue_flag = args.thermavue
+    settings.luma_flag = args.luminance
+    settings.pyramid_flag = args.pyramid
+    settings.agc_flag = args.auto_gain
+    settings.threshold_mode = args.threshold
+    settings.opacity = args.opacity
+
+    start = time.perf_counter()
+    count = reprocess(args.visible, args.thermal, args.output, settings, args.chunk, args.sub_chunk)
+    elapsed = time.perf_counter() - start
+    print(f"Fused {count} frames in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.1f} fps)")
+    sys.exit(0 if count else 1)
@@ -0,0 +1,260 @@
+"""
+Description: the frame bus. The camera frames and the fused frame of a pair are published into rings of
+shared memory, so other programs on the same machine (analytics, archiving) can read them without opening the
+cameras or grabbing the screen. A reader gets a numpy view straight into the shared memory, nothing is copied.
+
+Every pair publishes three streams, named <bus name>_<stream>:
+    visible     the visible frame, 480x640x3, in the channel order of the pipeline (see fusion.py)
+    termo       the single channel thermal frame, 480x640
+    fused       the fused frame as shown in the view, 480x640x3
+The three frames taken from the same camera grab have the same sequence number.
+
+Reading from another program:
+    reader = framebus.RingReader("fusion0_fused")
+    frame = reader.next()               # waits for a frame newer than the last one read
+    ... use frame.image ...
+    if not reader.still_valid(frame):   # the writer has reused the slot meanwhile, drop the result
+        ...
+
+Run "python framebus.py fusion0" to watch the streams of a pair.
+
+"""
+
+import os
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+MAGIC = 0x46555342  # "FUSB"
+VERSION = 1
+HEADER_FIELDS = 8  # magic, version, slots, height, width, channels, latest sequence number, writer process id
+# A reader which finds the newest slot being written tries again this often, a moment apart, before giving up
+LATEST_TRIES = 10
+STREAMS = ["visible", "termo", "fused"]
+
+BusFrame = namedtuple("BusFrame", ["seq", "timestamp", "image"])
+
+
+def attach(name):
+    '''Opens an existing shared memory block without handing it to Python's resource tracker, which would
+    otherwise remove the block when the reading program exits. Meant for other programs: within the writing
+    program itself this would also drop the writer's own registration.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track = False)
+    memory = shared_memory.SharedMemory(name)
+    if sys.platform != "win32":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+def process_alive(pid):
+    '''Tells if the process of a ring's writer still runs.
+    '''
+    if pid <= 0:
+        return False
+    if sys.platform == "win32":
+        # Windows frees named shared memory with its last handle, a ring which still exists has a live owner
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FrameRing:
+    def __init__(self, memory, slots = None, shape = None):
+        '''Lays out a ring in a block of shared memory: a header, a sequence number and a timestamp per slot,
+        then the frames. Pass slots and shape to write a new header, leave them out to read an existing one.
+        '''
+        self.memory = memory
+        self.header = np.ndarray((HEADER_FIELDS,), np.int64, memory.buf)
+        if slots is not None:
+            height, width = shape[:2]
+            channels = shape[2] if len(shape) == 3 else 1
+            self.header[:] = [MAGIC, VERSION, slots, height, width, channels, -1, os.getpid()]
+        if self.header[0] != MAGIC or self.header[1] != VERSION:
+            raise ValueError(f"{memory.name} is not a frame bus ring")
+
+        self.slots, height, width, channels = (int(value) for value in self.header[2:6])
+        self.shape = (height, width) if channels == 1 else (height, width, channels)
+        offset = self.header.nbytes
+        # Per slot: the sequence number of the frame in it (-1 while it is written) and its timestamp in ns
+        self.slot_info = np.ndarray((self.slots, 2), np.int64, memory.buf, offset)
+        offset += self.slot_info.nbytes
+        self.frames = np.ndarray((self.slots,) + self.shape, np.uint8, memory.buf, offset)
+
+    @staticmethod
+    def size(slots, shape):
+        return (HEADER_FIELDS + 2 * slots) * 8 + slots * int(np.prod(shape))
+
+    def release(self):
+        '''Drops the views into the shared memory, which has to happen before the memory is closed.
+        '''
+        self.header = self.slot_info = self.frames = None
+
+
+class RingWriter:
+    def __init__(self, name, shape, slots = 8):
+        '''Creates a ring of shared memory for frames of one shape. A ring left behind by a writer which did not
+        exit cleanly is replaced, a ring whose writer still runs raises FileExistsError.
+        '''
+        size = FrameRing.size(slots, shape)
+        try:
+            self.memory = shared_memory.SharedMemory(name, create = True, size = size)
+        except FileExistsError:
+            old = shared_memory.SharedMemory(name)
+            header = np.ndarray((HEADER_FIELDS,), np.int64, old.buf) if old.size >= HEADER_FIELDS * 8 else None
+            owner = int(header[7]) if header is not None and header[0] == MAGIC else 0
+            header = None
+            if process_alive(owner):
+                old.close()
+                raise FileExistsError(f"{name} is published by the running process {owner}")
+            old.close()
+            old.unlink()
+            self.memory = shared_memory.SharedMemory(name, create = True, size = size)
+        self.ring = FrameRing(self.memory, slots, shape)
+        self.ring.slot_info[:] = -1
+
+    def write(self, seq, timestamp, image):
+        '''Copies a frame into the next slot. The slot is marked as being written first, so a reader never takes
+        a half written frame for a whole one.
+        '''
+        ring = self.ring
+        slot = seq % ring.slots
+        ring.slot_info[slot, 0] = -1
+        ring.frames[slot] = image
+        ring.slot_info[slot, 1] = timestamp
+        ring.slot_info[slot, 0] = seq
+        ring.header[6] = seq
+
+    def close(self):
+        self.ring.release()
+        self.memory.close()
+        self.memory.unlink()
+
+
+class RingReader:
+    def __init__(self, name):
+        '''Opens the ring of a stream which a running pair publishes, e.g. "fusion0_fused".
+        '''
+        self.memory = attach(name)
+        self.ring = FrameRing(self.memory)
+        self.last_seq = -1
+
+    def latest(self):
+        '''Returns the newest frame as a BusFrame whose image is a view into the shared memory, or None if there
+        is no frame yet or the newest slot stays half written (a writer which stopped in the middle of a frame).
+        '''
+        ring = self.ring
+        for _ in range(LATEST_TRIES):
+            seq = int(ring.header[6])
+            if seq < 0:
+                return None
+            slot = seq % ring.slots
+            timestamp = int(ring.slot_info[slot, 1])
+            if ring.slot_info[slot, 0] == seq:
+                self.last_seq = seq
+                return BusFrame(seq, timestamp, ring.frames[slot])
+            time.sleep(0.0005)
+        return None
+
+    def next(self, timeout = 1.0):
+        '''Waits for a frame newer than the last one read and returns it, or None after the timeout.
+        '''
+        deadline = time.perf_counter() + timeout
+        while int(self.ring.header[6]) <= self.last_seq:
+            if time.perf_counter() > deadline:
+                return None
+            time.sleep(0.001)
+        return self.latest()
+
+    def still_valid(self, frame):
+        '''Tells if the slot of a frame still holds it. Check this after using a frame's image, since the writer
+        reuses the slot once it has gone round the ring.
+        '''
+        return self.ring.slot_info[frame.seq % self.ring.slots, 0] == frame.seq
+
+    def copy(self, frame):
+        '''Returns a copy of a frame's image which stays valid, or None if the slot was reused while copying.
+        '''
+        image = frame.image.copy()
+        return image if self.still_valid(frame) else None
+
+    def close(self):
+        self.ring.release()
+        self.memory.close()
+
+
+class FrameBus:
+    def __init__(self, name, slots = 8):
+        '''Publishes the frames of one pair under the given name. The rings are created with the first frames.
+        '''
+        self.name = name
+        self.slots = slots
+        self.writers = {}
+
+    def publish(self, seq, timestamp, frames):
+        '''Writes the frames of one grab, given by stream name, into their rings.
+        '''
+        for stream, image in frames.items():
+            writer = self.writers.get(stream)
+            if writer is not None and writer.ring.shape != image.shape:
+                writer.close()
+                writer = None
+            if writer is None:
+                writer = self.writers[stream] = RingWriter(f"{self.name}_{stream}", image.shape, self.slots)
+            writer.write(seq, timestamp, image)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+if __name__ == '__main__':
+    # Test reader: prints the frame rate, the age of the frames and the skipped frames of every stream of a pair
+    name = sys.argv[1] if len(sys.argv) > 1 else "fusion0"
+    readers = {stream: RingReader(f"{name}_{stream}") for stream in STREAMS}
+    print(f"Reading {', '.join(f'{name}_{stream}' for stream in STREAMS)}, Ctrl+C to stop", flush = True)
+    counts = {stream: 0 for stream in STREAMS}
+    skipped = {stream: 0 for stream in STREAMS}
+    ages = {stream: [] for stream in STREAMS}
+    last = {stream: -1 for stream in STREAMS}
+    start = time.perf_counter()
+    try:
+        while True:
+            for stream, reader in readers.items():
+                frame = reader.next(timeout = 0)
+                if frame is None:
+                    continue
+                ages[stream].append((time.time_ns() - frame.timestamp) / 1e6)
+                if last[stream] >= 0:
+                    skipped[stream] += frame.seq - last[stream] - 1
+                last[stream] = frame.seq
+                counts[stream] += 1
+                # Reads the whole image, like a program which uses the frames would
+                frame.image.mean()
+                if not reader.still_valid(frame):
+                    skipped[stream] += 1
+
+            elapsed = time.perf_counter() - start
+            if elapsed >= 1:
+                for stream in STREAMS:
+                    age = f"{np.mean(ages[stream]):.1f} ms" if ages[stream] else "-"
+                    print(f"{stream:8s} seq {last[stream]:7d}  {counts[stream] / elapsed:5.1f} fps  age {age:>9s}  skipped {skipped[stream]}")
+                print(flush = True)
+                counts = {stream: 0 for stream in STREAMS}
+                ages = {stream: [] for stream in STREAMS}
+                start = time.perf_counter()
+            time.sleep(0.001)
+    except KeyboardInterrupt:
+        pass
+    for reader in readers.values():
+        reader.close()
@@ -0,0 +1,964 @@
+"""
+Description: the processing side of the interface. Reads frames from one thermal/visible camera pair and
+fuses them according to the flags of that pair. Nothing in this file touches Qt widgets, so the work can
+be handed to the worker pool which is shared by every camera pair in the process.
+
+"""
+
+import os
+import sys
+import math
+import time
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from analytics import (ThermalAnalytics, ThermalHistogram, ThermalChangeDetector, WarmObjectDetector, Y16Mapper,
+                       StatsLog, ObjectLog, celsius)
+
+_worker_pool = None
+_pyramid_pool = None
+
+# Waiting time before the first reconnect attempt after a camera is lost, doubled after every failed attempt up to the maximum
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.0
+
+# Frames read and thrown away after the cameras are opened, while their exposure and gain settle
+WARMUP_FRAMES = 5
+CAMERA_NAMES = {"termo": "Thermal", "visible": "Visible"}
+
+# The ways the ThermaVue threshold can be set, see thermalThreshold
+THRESHOLD_MODES = ["Fixed", "Otsu", "Hottest 5%"]
+
+# The registered fusion stages in the order they are tried, see register_stage
+Stage = namedtuple("Stage", ["name", "function", "inputs", "output", "settings", "when", "preallocate"])
+STAGES = []
+
+# Camera sources which are not devices, by the camera index they are selected with, see register_source
+SOURCES = {}
+
+# Views of the multi-view layout which show a frame of the pipeline rather than a fused mode, see composeViews
+VIEW_FRAMES = {"visible": "visible", "thermal": "termoRGB"}
+
+# Time between the two cameras of a pair taking their frames, in milliseconds
+PairSkew = namedtuple("PairSkew", ["last", "mean", "max"])
+
+# The quality levels a pair steps through to hold its target frame rate, see QualityController. fast_edges uses the
+# cheaper edge filter, scale is the size at which the stages run (the fused frame is scaled back to 640x480), and
+# thermal_every reruns the stages which only read the thermal frame on every n-th frame, reusing them in between.
+QualityLevel = namedtuple("QualityLevel", ["name", "fast_edges", "scale", "thermal_every"])
+QUALITY_LEVELS = [
+    QualityLevel("Full", False, 1.0, 1),
+    QualityLevel("Fast edges", True, 1.0, 1),
+    QualityLevel("Reduced", True, 0.75, 1),
+    QualityLevel("Low", True, 0.5, 1),
+    QualityLevel("Minimum", True, 0.5, 2),
+]
+
+# The JET colour map as lookup tables in the RGB channel order of the pipeline, the smooth one is used by ThermaVue
+JET_RGB = np.ascontiguousarray(cv2.applyColorMap(np.arange(256, dtype = np.uint8).reshape(256, 1), cv2.COLORMAP_JET)[:, :, ::-1])
+JET_RGB_SMOOTH = cv2.GaussianBlur(JET_RGB, (5, 5), 0)
+JET_RGB_SMOOTH[0] = 0  # black stays black, ThermaVue only colours the warm objects
+
+
+def get_worker_pool():
+    '''Returns the worker pool shared by all camera pairs. The pool is sized to the machine, so adding
+    more pairs adds work to the queue rather than more threads.
+    '''
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = ThreadPoolExecutor(max_workers = os.cpu_count() or 1, thread_name_prefix = "fusion")
+    return _worker_pool
+
+
+def get_pyramid_pool():
+    '''Returns the pool which builds the thermal pyramid of the pyramid fusion mode while the worker of the pair
+    builds the visible one. It is kept apart from the worker pool, since the worker waits for it.
+    '''
+    global _pyramid_pool
+    if _pyramid_pool is None:
+        _pyramid_pool = ThreadPoolExecutor(max_workers = os.cpu_count() or 1, thread_name_prefix = "fusion-pyramid")
+    return _pyramid_pool
+
+
+def register_source(index, factory):
+    '''Makes the pipeline open factory() instead of the camera device with this index, for example to feed it with
+    synthetic or recorded frames (see soak.py). The source needs the grab, retrieve, isOpened and release methods
+    of cv2.VideoCapture.
+    '''
+    SOURCES[index] = factory
+
+
+def open_camera(index, y16 = False):
+    '''Opens the camera with the given index, or the source registered for it. With y16 set the camera is asked
+    for raw 16 bit frames (Y16) which OpenCV hands over as they are, as radiometric thermal cameras deliver them.
+    '''
+    if index in SOURCES:
+        return SOURCES[index]()
+    if not y16:
+        return cv2.VideoCapture(index, cv2.CAP_DSHOW)
+    camera = cv2.VideoCapture(index, cv2.CAP_V4L2 if sys.platform.startswith("linux") else cv2.CAP_DSHOW)
+    camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"Y16 "))
+    camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    return camera
+
+
+def configure_threads(pair_count):
+    '''Splits the cores between the pairs. Every pair already runs on its own worker, so OpenCV gets the
+    remaining share of cores instead of starting a full set of threads per call.
+    '''
+    cores = os.cpu_count() or 1
+    cv2.setNumThreads(max(1, cores // max(1, pair_count)))
+
+
+class SkewMeter:
+    def __init__(self, window = 100):
+        '''Keeps the skew of the last frames of a pair.
+        '''
+        self.samples = deque(maxlen = window)
+
+    def add(self, skew):
+        '''Adds the skew of one frame pair, in seconds.
+        Returns: PairSkew with the last, mean and largest skew of the window in milliseconds.
+        '''
+        self.samples.append(skew * 1000)
+        return PairSkew(self.samples[-1], sum(self.samples) / len(self.samples), max(self.samples))
+
+
+class QualityController:
+    def __init__(self, down_after = 10, up_after = 60, hold = 30, forget = 600):
+        '''Picks the quality level of a pair from its processing time. The smoothed time of a frame is compared with
+        the frame budget (1000 / target fps): the level goes down after down_after frames in a row above 90% of the
+        budget, and up after up_after frames in a row below 60%. The gap between the two and the longer wait before
+        going up keep the level from going back and forth, and after every change it is held for hold frames.
+        A level which was left for being too slow is not tried again until forget frames later, since the scene or
+        the mode may have changed by then, and every time it turns out too slow again the wait doubles (up to 8 times).
+        '''
+        self.down_after = down_after
+        self.up_after = up_after
+        self.hold = hold
+        self.forget = forget
+        self.level = 0
+        self.average = None
+        self.over = 0
+        self.under = 0
+        self.held = 0
+        self.frames = 0
+        # The frame from which each level which was left for being too slow may be tried again, and how often it was
+        self.retry_at = {}
+        self.failures = {}
+
+    def update(self, elapsed, target_fps):
+        '''Adds the processing time of one frame in milliseconds.
+        Returns: the index of the quality level in QUALITY_LEVELS, always 0 when target_fps is 0 (no target).
+        '''
+        if not target_fps:
+            self.level = 0
+            return self.level
+        budget = 1000.0 / target_fps
+        self.frames += 1
+        self.average = elapsed if self.average is None else self.average + 0.2 * (elapsed - self.average)
+        if self.held > 0:
+            self.held -= 1
+            return self.level
+
+        self.over = self.over + 1 if self.average > 0.9 * budget else 0
+        self.under = self.under + 1 if self.average < 0.6 * budget else 0
+        if self.over >= self.down_after and self.level < len(QUALITY_LEVELS) - 1:
+            failures = self.failures[self.level] = self.failures.get(self.level, 0) + 1
+            self.retry_at[self.level] = self.frames + self.forget * 2 ** min(failures - 1, 3)
+            self.change(self.level + 1)
+        elif self.under >= self.up_after and self.level > 0 and self.frames >= self.retry_at.get(self.level - 1, 0):
+            self.change(self.level - 1)
+        return self.level
+
+    def change(self, level):
+        # The time at the new level is measured afresh
+        self.level = level
+        self.average = None
+        self.over = self.under = 0
+        self.held = self.hold
+
+
+class LaplacianFusion:
+    def __init__(self, levels = 4):
+        '''Keeps the buffers of the pyramid fusion mode. Every level halves the frame, so 4 levels take 640x480
+        down to a 40x30 base. The buffers are only allocated again when the frame size changes.
+        '''
+        self.levels = levels
+        self.shape = None
+
+    def allocate(self, shape):
+        h, w = shape
+        sizes = [(h, w)]
+        for _ in range(self.levels):
+            h, w = (h + 1) // 2, (w + 1) // 2
+            sizes.append((h, w))
+
+        # Per camera: the downsampled levels, the levels scaled back up, the detail of every scale and its magnitude
+        self.pyramids = {}
+        for source in ("visible", "termo"):
+            self.pyramids[source] = {
+                "levels": [np.empty(size, np.uint8) for size in sizes[1:]],
+                "upsampled": [np.empty(size, np.uint8) for size in sizes[:-1]],
+                "detail": [np.empty(size, np.int16) for size in sizes[:-1]],
+                "magnitude": [np.empty(size, np.int16) for size in sizes[:-1]],
+            }
+        self.stronger = [np.empty(size, np.bool_) for size in sizes[:-1]]
+        self.base = np.empty(sizes[-1], np.int16)
+        self.upsampled = [np.empty(size, np.int16) for size in sizes[:-1]]
+        self.rebuilt = [np.empty(size, np.int16) for size in sizes[1:-1]]
+        self.result = np.empty(sizes[0], np.uint8)
+        self.shape = shape
+
+    def prepare(self, shape):
+        if self.shape != shape:
+            self.allocate(shape)
+
+    def decompose(self, frame, source):
+        '''Builds the Laplacian pyramid of a single channel frame into the buffers of a camera: the detail of every
+        scale is the difference between a level and the next smaller level scaled back up.
+        '''
+        pyramid = self.pyramids[source]
+        level = frame
+        for smaller, upsampled, detail, magnitude in zip(pyramid["levels"], pyramid["upsampled"],
+                                                         pyramid["detail"], pyramid["magnitude"]):
+            cv2.pyrDown(level, dst = smaller)
+            cv2.pyrUp(smaller, dst = upsampled, dstsize = (level.shape[1], level.shape[0]))
+            cv2.subtract(level, upsampled, dst = detail, dtype = cv2.CV_16S)
+            np.abs(detail, out = magnitude)
+            level = smaller
+
+    def combine(self, opacity):
+        '''Fuses the two decomposed frames. The smallest levels, which hold the overall brightness, are blended at
+        the opacity like the other modes. On every other scale each pixel takes the detail of the camera whose detail
+        is stronger there, then the pyramid is collapsed back into one frame.
+        Returns: the fused single channel frame (a buffer which is reused for the next frame).
+        '''
+        visible, termo = self.pyramids["visible"], self.pyramids["termo"]
+        cv2.addWeighted(visible["levels"][-1], 1 - opacity / 100.0, termo["levels"][-1], opacity / 100.0, 0,
+                        dst = self.base, dtype = cv2.CV_16S)
+        level = self.base
+        for scale in reversed(range(self.levels)):
+            detail = visible["detail"][scale]
+            np.greater(termo["magnitude"][scale], visible["magnitude"][scale], out = self.stronger[scale])
+            np.copyto(detail, termo["detail"][scale], where = self.stronger[scale])
+
+            upsampled = self.upsampled[scale]
+            cv2.pyrUp(level, dst = upsampled, dstsize = (upsampled.shape[1], upsampled.shape[0]))
+            if scale > 0:
+                level = cv2.add(upsampled, detail, dst = self.rebuilt[scale - 1])
+            else:
+                cv2.add(upsampled, detail, dst = self.result, dtype = cv2.CV_8U)
+        return self.result
+
+
+class FusionPipeline:
+    def __init__(self, settings):
+        '''Initialises the pipeline of one camera pair. The settings object holds the flags of the pair
+        (the variables module for the first pair, variables.PairSettings for the others).
+        '''
+        self.settings = settings
+        self.termoCamera = None
+        self.visibleCamera = None
+        self.analytics = ThermalAnalytics()
+        self.histogram = ThermalHistogram()
+        self.change_detector = ThermalChangeDetector()
+        self.watching_changes = False
+        self.laplacian = LaplacianFusion()
+        self.y16 = Y16Mapper()
+        # The raw 16 bit thermal frame (640x480) of the latest grab, None for 8 bit thermal cameras
+        self.termoRaw = None
+        self.stats_log = None
+        self.warm_objects = WarmObjectDetector()
+        self.objects_log = None
+        self.skew = SkewMeter()
+        self.quality_controller = QualityController()
+        self.quality = QUALITY_LEVELS[0]
+        # How long grab() usually takes per camera, the slower camera is grabbed first
+        self.grab_time = {"visible": 0.0, "termo": 0.0}
+
+        # Lost or swapped cameras are opened again on a background thread, the frames are skipped meanwhile
+        self.connected = {"termo": None, "visible": None}
+        self.reconnecting = set()
+        self.reconnect_thread = None
+        self.camera_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.camera_status = None
+
+        # Average run time of every stage in milliseconds, the stages run since the last frame started (the views
+        # of the multi-view layout run after the fused frame) and the reused output buffers of the stages
+        self.stage_times = {}
+        self.stages_run = set()
+        self.buffers = {}
+        # The frames made from the latest camera grab, the views of the multi-view layout are made from them
+        self.frames = None
+
+        # Frames are numbered from the camera grab on, the frame bus publishes them under these numbers
+        self.frame_seq = -1
+        self.grab_stamp = 0
+        # Milliseconds the latest frame took from the end of the camera grab until it was fused
+        self.process_time = 0.0
+        self.frame_bus = None
+
+    def connectToCameras(self, warmup = 0, progress = None):
+        '''Connects to the cameras selected for this pair. Both devices are opened at the same time. With warmup,
+        that many frames are read and thrown away while the cameras settle, then every stage is run once on the
+        last of them (see prerun). progress(message) is called before every step, from the calling thread.
+        Output: camera1 and camera2.
+        '''
+        report = progress or (lambda message: None)
+        report("Opening the thermal and visible cameras...")
+        indexes = {"termo": self.settings.termo, "visible": self.settings.visible}
+        cameras = self.openCameras(indexes)
+        self.termoCamera, self.visibleCamera = cameras["termo"], cameras["visible"]
+        self.connected = indexes
+
+        for count in range(warmup):
+            report(f"Warming up the cameras ({count + 1}/{warmup})...")
+            ret1, visibleFrame, ret2, termoFrame = self.readPair()
+            if not ret1 or not ret2:
+                # process_frame reconnects the camera which failed
+                break
+        else:
+            if warmup:
+                report("Preparing the processing...")
+                self.prerun(visibleFrame, termoFrame)
+        return self.termoCamera, self.visibleCamera
+
+    def openCameras(self, indexes):
+        '''Opens cameras given as name: device index, each on its own thread, since opening a device can take
+        seconds and the devices do not wait for each other.
+        Returns: the cameras by name.
+        '''
+        cameras = {}
+
+        def open_one(name, index):
+            cameras[name] = open_camera(index, self.settings.y16_flag and name == "termo")
+
+        threads = [threading.Thread(target = open_one, args = item, name = f"fusion-open-{item[0]}") for item in indexes.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return cameras
+
+    def prerun(self, visibleFrame, termoFrame):
+        '''Runs every registered stage once on a pair of camera frames and throws the results away. OpenCV sets up
+        its kernels, tables and threads on their first call, so this moves that cost from the first frames shown
+        (and from the first switch to another mode) to the connection. The output buffers of the stages are kept.
+        '''
+        visibleFrame, termoFrame, threshold, _ = self.prepareFrames(visibleFrame, termoFrame)
+        frames = {"visible": visibleFrame, "termo": termoFrame, "threshold": threshold}
+        for stage in STAGES:
+            self.callStage(stage, frames)
+        self.stage_times = {}
+        self.stages_run = set()
+
+    def release(self):
+        '''Releases both cameras of the pair and stops a reconnect which is still running.
+        '''
+        self.stopping.set()
+        with self.camera_lock:
+            for camera in (self.termoCamera, self.visibleCamera):
+                if camera is not None:
+                    camera.release()
+            self.termoCamera = None
+            self.visibleCamera = None
+        self.update_stats_log(None)
+        self.update_objects_log(None)
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+            self.frame_bus = None
+
+    def cameraIndex(self, name):
+        '''Returns the device index currently selected for the thermal ("termo") or the visible camera.
+        '''
+        return self.settings.termo if name == "termo" else self.settings.visible
+
+    def setCamera(self, name, camera):
+        if name == "termo":
+            self.termoCamera = camera
+        else:
+            self.visibleCamera = camera
+
+    def startReconnect(self, names):
+        '''Opens the given cameras again on a background thread. Used when a camera stops delivering frames and
+        when the user picks another device. Nothing here waits for a camera, so the caller returns at once.
+        '''
+        with self.camera_lock:
+            self.reconnecting.update(names)
+            if self.reconnect_thread is None:
+                self.reconnect_thread = threading.Thread(target = self.reconnect, name = "fusion-reconnect", daemon = True)
+                self.reconnect_thread.start()
+
+    def reconnect(self):
+        '''Runs on the reconnect thread. Releases the cameras which need reconnecting and opens them again,
+        waiting twice as long after every failed attempt. A camera counts as connected once it delivers a frame.
+        '''
+        delay = RECONNECT_DELAY
+        attempt = 1
+        while not self.stopping.is_set():
+            with self.camera_lock:
+                # A device picked by the user while waiting is reconnected in the same go
+                self.reconnecting.update(name for name in CAMERA_NAMES if self.cameraIndex(name) != self.connected[name])
+                names = set(self.reconnecting)
+                for name in names:
+                    camera = self.termoCamera if name == "termo" else self.visibleCamera
+                    if camera is not None:
+                        camera.release()
+                    self.setCamera(name, None)
+
+            opened = {}
+            indexes = {name: self.cameraIndex(name) for name in names}
+            for name, camera in self.openCameras(indexes).items():
+                index = indexes[name]
+                if camera.isOpened() and camera.grab():
+                    opened[name] = (camera, index)
+                else:
+                    camera.release()
+
+            label = " and ".join(CAMERA_NAMES[name] for name in sorted(names)).lower().capitalize()
+            if len(opened) == len(names):
+                with self.camera_lock:
+                    if self.stopping.is_set():
+                        for camera, _ in opened.values():
+                            camera.release()
+                        return
+                    for name, (camera, index) in opened.items():
+                        self.setCamera(name, camera)
+                        self.connected[name] = index
+                    self.camera_status = f"{label} camera connected."
+                    self.reconnecting -= names
+                    if not self.reconnecting:
+                        self.reconnect_thread = None
+                        return
+                delay = RECONNECT_DELAY
+                attempt = 1
+                continue
+
+            for camera, _ in opened.values():
+                camera.release()
+            self.camera_status = f"{label} camera not available, trying again in {delay:.1f} s (attempt {attempt})."
+            if self.stopping.wait(delay):
+                return
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            attempt += 1
+
+    def update_stats_log(self, path):
+        '''Opens the statistics CSV file when a new path is set and closes it when the path is cleared.
+        '''
+        if self.stats_log is not None and self.stats_log.path != path:
+            self.stats_log.close()
+            self.stats_log = None
+        if path is not None and self.stats_log is None:
+            self.stats_log = StatsLog(path)
+
+    def update_objects_log(self, path):
+        '''Opens the warm objects CSV file when a new path is set and closes it when the path is cleared.
+        '''
+        if self.objects_log is not None and self.objects_log.path != path:
+            self.objects_log.close()
+            self.objects_log = None
+        if path is not None and self.objects_log is None:
+            self.objects_log = ObjectLog(path)
+
+    def readPair(self):
+        '''Reads one frame from both cameras as close together in time as possible. grab() only latches the next
+        frame, so both cameras are grabbed first and decoded afterwards with retrieve(). The camera which usually
+        takes longer to deliver a frame is grabbed first, so the second grab returns soon after the first.
+        Output: ret1, visibleFrame, ret2, termoFrame.
+        '''
+        cameras = {"visible": self.visibleCamera, "termo": self.termoCamera}
+        grabbed, grabbed_at = {}, {}
+        for name in sorted(cameras, key = lambda name: self.grab_time[name], reverse = True):
+            start = time.perf_counter()
+            grabbed[name] = cameras[name].grab()
+            grabbed_at[name] = time.perf_counter()
+            self.grab_time[name] += 0.1 * (grabbed_at[name] - start - self.grab_time[name])
+
+        if not grabbed["visible"] or not grabbed["termo"]:
+            return grabbed["visible"], None, grabbed["termo"], None
+
+        self.settings.skew = self.skew.add(abs(grabbed_at["visible"] - grabbed_at["termo"]))
+        self.grab_stamp = time.time_ns()
+        ret1, visibleFrame = self.visibleCamera.retrieve()
+        ret2, termoFrame = self.termoCamera.retrieve()
+        return ret1, visibleFrame, ret2, termoFrame
+
+    def thermalStatistics(self, gray_frame):
+        '''Computes the statistics of the grey thermal frame, keeps them in the settings and logs them if a file is set.
+        The statistics of a raw 16 bit frame are temperatures in degrees Celsius.
+        '''
+        stats = self.analytics.analyse(gray_frame)
+        if gray_frame.dtype == np.uint16:
+            low, high, mean = celsius([stats.min, stats.max, stats.mean], self.settings.thermal_calibration)
+            stats = stats._replace(min = float(low), max = float(high), mean = float(mean), unit = "C")
+        self.settings.stats = stats
+        self.update_stats_log(self.settings.stats_log)
+        if self.stats_log is not None:
+            self.stats_log.write(stats)
+        return stats
+
+    def warmObjects(self, gray_frame, threshold):
+        '''Finds the warm objects of the grey thermal frame with the ThermaVue threshold, keeps them in the settings
+        and logs them if a file is set.
+        '''
+        objects = self.warm_objects.update(gray_frame, threshold)
+        self.settings.objects = objects
+        self.update_objects_log(self.settings.objects_log)
+        if self.objects_log is not None:
+            self.objects_log.write(objects)
+        return objects
+
+    def thermalThreshold(self, gray_frame, gain = True):
+        '''Updates the shared thermal histogram and reads the ThermaVue threshold and the gain from it.
+        Returns: the threshold for pureThermalOnVisible and the gain lookup table (None when the gain is off, or
+        when gain is False because the frame was already stretched).
+        '''
+        settings = self.settings
+        self.histogram.update(gray_frame)
+        lut = self.histogram.agc_lut() if settings.agc_flag and gain else None
+
+        # Warm pixels are the ones above the returned intensity, ThermaVue works on the inverted frame
+        if settings.threshold_mode == "Otsu":
+            warm = self.histogram.otsu()
+        elif settings.threshold_mode == "Hottest 5%":
+            warm = self.histogram.percentile(95)
+        else:
+            return 100, lut
+
+        if lut is not None:
+            warm = int(lut[warm])
+        return 255 - warm, lut
+
+    def findStage(self, name):
+        '''Returns the first registered stage which makes the named frame and whose condition holds.
+        '''
+        for stage in STAGES:
+            if stage.output == name and (stage.when is None or stage.when(self.settings)):
+                return stage
+        raise KeyError(f"No fusion stage makes the {name} frame")
+
+    def runStage(self, name, frames):
+        '''Produces a named frame with the first registered stage for it whose condition holds, running the stages
+        for its inputs first. Every frame is made at most once per processed frame, so only the frames the current
+        mode needs are computed.
+        Input: name of the frame and the frames made so far (visible, termo and threshold to begin with).
+        Returns: the frame.
+        '''
+        if name in frames:
+            return frames[name]
+        frame = self.callStage(self.findStage(name), frames)
+        frames[name] = frame
+        return frame
+
+    def callStage(self, stage, frames):
+        '''Runs one stage on its input frames, which are made first if needed, and measures its run time.
+        '''
+        self.stages_run.add(stage.name)
+        # At the lowest quality a stage which only reads the thermal frame keeps its frame from the frame before
+        if (stage.preallocate and stage.inputs == ("termo",) and stage.name in self.buffers
+                and self.frame_seq % self.quality.thermal_every):
+            return self.buffers[stage.name]
+
+        inputs = [self.runStage(input_name, frames) for input_name in stage.inputs]
+        kwargs = {setting: getattr(self.settings, setting) for setting in stage.settings}
+        if stage.preallocate and stage.name in self.buffers:
+            kwargs["out"] = self.buffers[stage.name]
+
+        start = time.perf_counter()
+        frame = stage.function(self, *inputs, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        average = self.stage_times.get(stage.name, elapsed)
+        self.stage_times[stage.name] = average + 0.1 * (elapsed - average)
+
+        if stage.preallocate:
+            self.buffers[stage.name] = frame
+        return frame
+
+    def highPassFilter(self, frame, out = None):
+        '''High pass filter to contour the live video feed. It first applies Gaussian blur with 3x3 kernel, then applies the Sobel filter in x and y directions and calculates the square root of sum of squares.
+        Input: a single frame
+        Output: a modified frame, the edges of the Y, U and V channels in that order. A single channel frame gives its edges as a single channel.
+        '''
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
+        if self.quality.fast_edges:
+            return self.fastHighPassFilter(frame, out)
+        gaussianFrame = cv2.GaussianBlur(frame, (5, 5), 0)
+        # The Sobel filters of an 8 bit frame only give whole numbers, so 32 bit floats give the same 8 bit result as 64 bit ones
+        sobel_x = cv2.Sobel(gaussianFrame, cv2.CV_32F, 1, 0, ksize = 3)
+        sobel_y = cv2.Sobel(gaussianFrame, cv2.CV_32F, 0, 1, ksize = 3)
+        squaredSobel = cv2.magnitude(sobel_x.reshape(-1), sobel_y.reshape(-1)).reshape(gaussianFrame.shape)
+        res = cv2.convertScaleAbs(squaredSobel, dst = out)
+        return res
+
+    def fastHighPassFilter(self, frame, out = None):
+        '''The cheaper edge filter of the lower quality levels: a 3x3 blur, the Sobel filter in 16 bit and the sum of
+        the absolute x and y edges instead of the square root of the sum of squares.
+        '''
+        blurredFrame = cv2.GaussianBlur(frame, (3, 3), 0)
+        edges_x = cv2.convertScaleAbs(cv2.Sobel(blurredFrame, cv2.CV_16S, 1, 0, ksize = 3))
+        edges_y = cv2.convertScaleAbs(cv2.Sobel(blurredFrame, cv2.CV_16S, 0, 1, ksize = 3))
+        return cv2.add(edges_x, edges_y, dst = out)
+
+    def thermalContour(self, frame, out = None):
+        '''Edges of the single channel thermal frame, placed in the last channel where they have always been shown.
+        '''
+        termoEdges = self.highPassFilter(frame)
+        blank = np.zeros_like(termoEdges)
+        return cv2.merge((blank, blank, termoEdges), dst = out)
+
+    def toRGB(self, frame, out = None):
+        '''The grey thermal frame as three channels, for blending with the visible frame.
+        '''
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB, dst = out)
+
+    def applyThermalColorMap(self, frame, out = None):
+        '''Applies the termal color mapping function from openCV to a current frame. The coloring is done based on pixel intensity.
+        Input: current frame, colour or the single channel thermal frame.
+        Returns: colored frame, in the RGB channel order of the pipeline.
+        '''
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) if frame.ndim == 3 else frame
+        colormap = cv2.applyColorMap(gray_frame, JET_RGB)
+        # colormap = 255 - colormap
+        colormap = cv2.GaussianBlur(colormap, (3, 3), 0, dst = out)
+        return colormap
+
+    def pureThermalOnVisible(self, frame, threshold = 100):
+        '''Thresholds a frame to achieve an image where the background is black and the objects are originally colored.
+        '''
+        '''DEVELOPER NOTE: the fixed threshold value for ThermaVue function is the default of the threshold argument. The current value is a 100. Adjust it if needed.
+        The automatic modes (Otsu, Hottest 5%) compute it from the thermal histogram in thermalThreshold.
+        '''
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) if frame.ndim == 3 else frame
+        mask = cv2.threshold(gray_frame, threshold, 255, cv2.THRESH_BINARY)[1]
+        inverted_mask = cv2.bitwise_not(mask)
+        result_frame = cv2.bitwise_and(frame, frame, mask = inverted_mask)
+        return result_frame
+
+    def toColoredObjects(self, frame):
+        '''Color maps the non-black pixels of the single channel thermal frame. Uses a blurred JET color map for a realistic 'thermal' view.
+        '''
+        return cv2.applyColorMap(frame, JET_RGB_SMOOTH)
+
+    def blendFrames(self, frame1, frame2, opacity):
+        '''Blends the two frames, the opacity (0-100, the trackbar value) is the weight of the second frame.
+        '''
+        return cv2.addWeighted(frame1, 1 - opacity / 100.0, frame2, opacity / 100.0, 0)
+
+    def blendMapped(self, frame1, frame2, opacity):
+        '''Blends the two frames and color maps the result, inverted.
+        '''
+        fusedFrame = self.blendFrames(frame1, frame2, opacity)
+        fusedFrame = self.applyThermalColorMap(fusedFrame)
+        return 255 - fusedFrame
+
+    def blendLuminance(self, visibleFrame, termoFrame, opacity):
+        '''Blends the single channel thermal frame into the luminance of the visible frame only. The colour of the
+        visible frame (Cr and Cb) is kept, so the view looks natural and the blend itself works on one channel.
+        '''
+        ycrcbFrame = cv2.cvtColor(visibleFrame, cv2.COLOR_RGB2YCrCb)
+        luminance = cv2.extractChannel(ycrcbFrame, 0)
+        cv2.addWeighted(luminance, 1 - opacity / 100.0, termoFrame, opacity / 100.0, 0, dst = luminance)
+        cv2.insertChannel(luminance, ycrcbFrame, 0)
+        return cv2.cvtColor(ycrcbFrame, cv2.COLOR_YCrCb2RGB)
+
+    def pyramidFusion(self, visibleFrame, termoFrame, opacity):
+        '''Fuses the single channel thermal frame into the luminance of the visible frame scale by scale (Laplacian
+        pyramids), so the edges and texture of both cameras are kept instead of being averaged away. The thermal
+        pyramid is built on another thread while the visible frame is converted and decomposed.
+        '''
+        self.laplacian.prepare(termoFrame.shape)
+        thermal = get_pyramid_pool().submit(self.laplacian.decompose, termoFrame, "termo")
+        ycrcbFrame = cv2.cvtColor(visibleFrame, cv2.COLOR_RGB2YCrCb)
+        luminance = cv2.extractChannel(ycrcbFrame, 0)
+        self.laplacian.decompose(luminance, "visible")
+        thermal.result()
+        cv2.insertChannel(self.laplacian.combine(opacity), ycrcbFrame, 0)
+        return cv2.cvtColor(ycrcbFrame, cv2.COLOR_YCrCb2RGB)
+
+    def thermaVue(self, visibleFrame, termoFrame, threshold):
+        '''Extracts the warm objects of the thermal frame, colors them and puts them over the visible frame.
+        '''
+        bwFrame = self.pureThermalOnVisible(255 - termoFrame, threshold)
+        coloredObjects = self.toColoredObjects(bwFrame)
+        fused = cv2.add(visibleFrame, coloredObjects)
+        # ThermaVue has always shown the fused frame in the reverse channel order of the other modes
+        return cv2.cvtColor(fused, cv2.COLOR_RGB2BGR)
+
+    def prepareFrames(self, visibleFrame, termoFrame, visible_out = None, termo_out = None):
+        '''Brings a pair of camera frames into the format of the pipeline: flips, converts the thermal frame to a
+        single channel, resizes both, and applies the thermal statistics, the threshold and the gain.
+        Input: the camera frames, and optionally 640x480 frames to write the visible and 8 bit thermal results into.
+        Returns: the visible frame, the thermal frame, the ThermaVue threshold and the statistics (None when off).
+        '''
+        settings = self.settings
+
+        ''' DEVELOPER NOTE:
+            Pixel format. The whole pipeline works in one channel order, the RGB order of the QImage which displays
+            the result, so the fused frame is handed to Qt without a conversion. The camera frames are used as they
+            come from OpenCV, which is how the view has always shown them. Colour maps use lookup tables in the same
+            order, and grey conversions use COLOR_RGB2GRAY.
+            The thermal frame is kept as a single channel through the gain, the edges, the threshold and the colour
+            map, and only becomes three channels when it is coloured by a lookup table or blended with the visible frame.
+        '''
+
+        ''' DEVELOPER NOTE:
+            A horizontal flip for a visible camera, adjust as needed. Examples:
+                visibleFrame = cv2.flip(visibleFrame, 1)  - horizontal flip for visible camera
+                termoFrame = cv2.flip(termoFrame, 1)  - horizontal flip for termo camera
+                termoFrame = cv2.flip(termoFrame, 0)  - vertical flip flip for termo camera
+        '''
+        visibleFrame = cv2.flip(visibleFrame, 1)
+
+        # Thermal cameras deliver grey frames which OpenCV expands to three channels, keep only one
+        if termoFrame.ndim == 3:
+            termoFrame = cv2.cvtColor(termoFrame, cv2.COLOR_RGB2GRAY)
+
+        # Resize both frames to 640x480
+        termoFrame = cv2.resize(termoFrame, (640, 480), dst = termo_out if termoFrame.dtype == np.uint8 else None)
+        visibleFrame = cv2.resize(visibleFrame, (640, 480), dst = visible_out)
+
+        # A raw 16 bit frame is kept for the temperatures, the rest of the pipeline gets it mapped to 8 bit.
+        # The mapping is also the gain, so the 8 bit gain is not applied again.
+        termoRaw = None
+        if termoFrame.dtype == np.uint16:
+            termoRaw = termoFrame
+            termoFrame = self.y16.map(termoRaw, settings.agc_flag)
+        self.termoRaw = termoRaw
+
+        # The "On change" recording modes only keep the moments when the thermal scene changes, before the gain.
+        # A raw frame is compared in tenths of a degree, since its 8 bit mapping follows the scene.
+        if settings.trigger_flag:
+            if not self.watching_changes:
+                self.change_detector.reset()
+            if termoRaw is None:
+                settings.last_change = self.change_detector.update(termoFrame, settings.trigger_sensitivity)
+            else:
+                slope = abs(settings.thermal_calibration[-2]) if len(settings.thermal_calibration) > 1 else 0
+                unit = 0.1 / slope if slope else 1.0
+                settings.last_change = self.change_detector.update(termoRaw, settings.trigger_sensitivity, unit)
+        self.watching_changes = settings.trigger_flag
+
+        # The grey thermal frame is shared by the statistics, the histogram and the gain.
+        # Thermal statistics and the hottest point are drawn on the fused frame at the end.
+        threshold = 100
+        stats = None
+        if settings.stats_flag:
+            stats = self.thermalStatistics(termoFrame if termoRaw is None else termoRaw)
+
+        if settings.agc_flag or settings.threshold_mode != "Fixed":
+            threshold, lut = self.thermalThreshold(termoFrame, gain = termoRaw is None)
+            if lut is not None:
+                termoFrame = cv2.LUT(termoFrame, lut, dst = termo_out)
+        settings.threshold = threshold
+        return visibleFrame, termoFrame, threshold, stats
+
+    def process_frame(self):
+        '''Reads one frame from both cameras and fuses them according to the flags of the pair.
+        Output: ret1, ret2 (whether each camera delivered a frame) and the fused frame, or None if there is no new frame.
+        '''
+        settings = self.settings
+
+        # Skip the frame while a camera is being reconnected, or start a reconnect if the user picked another device
+        if not self.reconnecting:
+            changed = [name for name in CAMERA_NAMES if self.cameraIndex(name) != self.connected[name]]
+            if changed:
+                self.startReconnect(changed)
+        if self.reconnecting:
+            return "visible" not in self.reconnecting, "termo" not in self.reconnecting, None
+
+        # Read the camera stream, both frames taken at nearly the same moment
+        ret1, visibleFrame, ret2, termoFrame = self.readPair()
+        if not ret1 or not ret2:
+            self.startReconnect([name for name, ret in (("visible", ret1), ("termo", ret2)) if not ret])
+            return ret1, ret2, None
+
+        start = time.perf_counter()
+        self.frame_seq += 1
+        # Stages which did not run for the frame before (another mode or views were picked) are not reported any more
+        self.stage_times = {name: average for name, average in self.stage_times.items() if name in self.stages_run}
+        self.stages_run = set()
+        visibleFrame, termoFrame, threshold, stats = self.prepareFrames(visibleFrame, termoFrame)
+
+        # The fused frame is made by the registered stages, see register_stage at the end of this file.
+        # Below full quality the stages run on smaller frames, the statistics and the overlays stay at 640x480.
+        frames = {"visible": visibleFrame, "termo": termoFrame, "threshold": threshold}
+        scale = self.quality.scale
+        if scale < 1:
+            size = (int(640 * scale), int(480 * scale))
+            # INTER_AREA is only fast for whole reductions (1/2), at 3/4 it would cost more than it saves
+            interpolation = cv2.INTER_AREA if (1 / scale).is_integer() else cv2.INTER_LINEAR
+            frames["visible"] = cv2.resize(visibleFrame, size, interpolation = interpolation)
+            frames["termo"] = cv2.resize(termoFrame, size, interpolation = interpolation)
+        if self.termoRaw is not None:
+            frames["termoRaw"] = self.termoRaw
+        fusedFrame = self.runStage("fused", frames)
+        if scale < 1:
+            fusedFrame = frames["fused"] = cv2.resize(fusedFrame, (640, 480))
+        settings.stage_times = dict(self.stage_times)
+        self.frames = frames
+
+        if settings.stats_flag:
+            self.analytics.draw(fusedFrame, stats)
+        else:
+            self.update_stats_log(None)
+
+        if settings.objects_flag:
+            self.warm_objects.draw(fusedFrame, self.warmObjects(termoFrame, threshold))
+        else:
+            self.update_objects_log(None)
+
+        if settings.frame_bus and not self.stopping.is_set():
+            self.publish(visibleFrame, termoFrame, fusedFrame)
+
+        self.process_time = (time.perf_counter() - start) * 1000
+        self.updateQuality(self.process_time)
+        return ret1, ret2, fusedFrame
+
+    def updateQuality(self, elapsed):
+        '''Moves the pair to the quality level which holds its target frame rate, given the processing time of the
+        last frame in milliseconds (the wait for the cameras is not counted).
+        '''
+        quality = QUALITY_LEVELS[self.quality_controller.update(elapsed, self.settings.target_fps)]
+        if quality is not self.quality:
+            if quality.scale != self.quality.scale:
+                # The reused output buffers have the size of the old scale
+                self.buffers = {}
+            self.quality = quality
+        self.settings.quality = quality.name
+
+    def spotTemperature(self, x, y):
+        '''Returns the temperature in degrees Celsius at a point of the 640x480 thermal frame, read from the raw
+        16 bit frame of the latest grab, or None when the thermal camera does not deliver raw frames.
+        '''
+        termoRaw = self.termoRaw
+        if termoRaw is None:
+            return None
+        return float(celsius(termoRaw[y, x], self.settings.thermal_calibration))
+
+    def viewFrame(self, view, frames):
+        '''Returns the frame shown by one view of the multi-view layout: "fused" (the current mode of the pair),
+        a camera frame from VIEW_FRAMES, or the name of a fused mode stage (e.g. "blendMap", "thermaVue").
+        A mode view only runs its final stage, its inputs come from the frames already made for the other views.
+        '''
+        if view == "fused":
+            return frames["fused"]
+        if view in VIEW_FRAMES:
+            return self.runStage(VIEW_FRAMES[view], frames)
+        if view in frames:
+            return frames[view]
+        if self.findStage("fused").name == view:
+            frames[view] = frames["fused"]
+        else:
+            stage = next((stage for stage in STAGES if stage.name == view and stage.output == "fused"), None)
+            if stage is None:
+                raise KeyError(f"Unknown view {view}")
+            frames[view] = self.callStage(stage, frames)
+        return frames[view]
+
+    def composeViews(self, views, width, height):
+        '''Tiles the views of the latest frame into one image of at most width x height, in a grid like the camera
+        pairs of the window. Every view is resized straight into its tile, so a view costs its final stage and the resize.
+        Returns: the tiled image in the channel order of the pipeline.
+        '''
+        columns = math.ceil(math.sqrt(len(views)))
+        rows = math.ceil(len(views) / columns)
+        tile_width = min(width // columns, (height // rows) * 4 // 3)
+        tile_height = tile_width * 3 // 4
+        composite = np.zeros((rows * tile_height, columns * tile_width, 3), np.uint8)
+        for idx, view in enumerate(views):
+            top = (idx // columns) * tile_height
+            left = (idx % columns) * tile_width
+            tile = composite[top:top + tile_height, left:left + tile_width]
+            cv2.resize(self.viewFrame(view, self.frames), (tile_width, tile_height), dst = tile, interpolation = cv2.INTER_LINEAR)
+        return composite
+
+    def publish(self, visibleFrame, termoFrame, fusedFrame):
+        '''Copies the frames of the current grab into the shared memory of the frame bus, for other programs to read.
+        '''
+        if self.frame_bus is None or self.frame_bus.name != self.settings.frame_bus:
+            from framebus import FrameBus
+            if self.frame_bus is not None:
+                self.frame_bus.close()
+            self.frame_bus = FrameBus(self.settings.frame_bus)
+        frames = {"visible": visibleFrame, "termo": termoFrame, "fused": fusedFrame}
+        try:
+            self.frame_bus.publish(self.frame_seq, self.grab_stamp, frames)
+        except FileExistsError as error:
+            # Another running instance publishes under the same name, this pair stops publishing instead of taking over
+            print(f"Frame bus: {error}")
+            self.frame_bus.close()
+            self.frame_bus = None
+            self.settings.frame_bus = None
+
+
+def register_stage(name, function, inputs, output = "fused", settings = (), when = None, preallocate = False, first = False):
+    '''Registers a fusion stage. A stage makes one named frame (output) from other named frames (inputs). The
+    pipeline starts with the visible, termo (single channel) and threshold frames and asks for the fused frame,
+    which is what the view shows. Several stages can make the same frame, the first registered one whose
+    condition holds is used.
+    Input:
+        name: unique name of the stage, also the key of its run time in stage_times. Registering a name again replaces the stage.
+        function: called as function(pipeline, *inputs, **settings) and returns the output frame.
+        inputs: names of the frames the stage needs.
+        settings: names of the pair settings passed to the function as keyword arguments.
+        when: function of the pair settings, the stage is only used when it returns True. None means always.
+        preallocate: the function also gets out = its output of the previous frame, to write the new frame into.
+            Not allowed for the fused frame, which is handed over to the view while the next frame is processed.
+        first: try the stage before the stages registered so far, for example a new mode which takes over
+            the fused frame when its own flag is set.
+    '''
+    if preallocate and output == "fused":
+        raise ValueError("The fused frame can not be preallocated")
+    STAGES[:] = [stage for stage in STAGES if stage.name != name]
+    stage = Stage(name, function, tuple(inputs), output, tuple(settings), when, preallocate)
+    if first:
+        STAGES.insert(0, stage)
+    else:
+        STAGES.append(stage)
+
+
+def blend_mode(termo, visible, colormap):
+    '''Condition of the built-in blend modes, which are selected by the contour and color map buttons.
+    '''
+    return lambda settings: (not settings.vue_flag and bool(settings.termo_flag) == termo
+                             and bool(settings.visible_flag) == visible and bool(settings.map_flag) == colormap)
+
+
+''' DEVELOPER NOTE:
+    The built-in modes. A new visualisation is added with register_stage, for example:
+        def sharpen(pipeline, frame):
+            return cv2.addWeighted(frame, 1.5, cv2.GaussianBlur(frame, (0, 0), 3), -0.5, 0)
+        register_stage("sharpen", sharpen, ["visible"], when = lambda settings: getattr(settings, "sharpen_flag", False), first = True)
+    The run time of every stage is kept in stage_times of the pair settings.
+'''
+register_stage("visibleHPF", FusionPipeline.highPassFilter, ["visible"], output = "visibleHPF", preallocate = True)
+register_stage("termoHPF", FusionPipeline.thermalContour, ["termo"], output = "termoHPF", preallocate = True)
+register_stage("termoRGB", FusionPipeline.toRGB, ["termo"], output = "termoRGB", preallocate = True)
+register_stage("termoMapped", FusionPipeline.applyThermalColorMap, ["termo"], output = "termoMapped", preallocate = True)
+
+register_stage("thermaVue", FusionPipeline.thermaVue, ["visible", "termo", "threshold"], when = lambda settings: settings.vue_flag)
+# If the luminance button is pressed, the contour and color map buttons are off then
+register_stage("blendLuminance", FusionPipeline.blendLuminance, ["visible", "termo"], settings = ["opacity"], when = lambda settings: settings.luma_flag)
+# If the pyramid button is pressed, the contour and color map buttons are off then
+register_stage("pyramidFusion", FusionPipeline.pyramidFusion, ["visible", "termo"], settings = ["opacity"], when = lambda settings: settings.pyramid_flag)
+# If no buttons are pressed
+register_stage("blend", FusionPipeline.blendFrames, ["visible", "termoRGB"], settings = ["opacity"], when = blend_mode(False, False, False))
+# If if map button is pressed
+register_stage("blendMap", FusionPipeline.blendFrames, ["visible", "termoMapped"], settings = ["opacity"], when = blend_mode(False, False, True))
+# If visible contouring is on
+register_stage("blendVisibleContour", FusionPipeline.blendFrames, ["visibleHPF", "termoRGB"], settings = ["opacity"], when = blend_mode(False, True, False))
+# If visible contour and color mapping is on at the same time
+register_stage("blendVisibleContourMap", FusionPipeline.blendFrames, ["visibleHPF", "termoMapped"], settings = ["opacity"], when = blend_mode(False, True, True))
+# If contour termo is on
+register_stage("blendTermoContour", FusionPipeline.blendFrames, ["visible", "termoHPF"], settings = ["opacity"], when = blend_mode(True, False, False))
+# If contour termo and color mapping is on at the same time
+register_stage("blendTermoContourMap", FusionPipeline.blendMapped, ["visible", "termoHPF"], settings = ["opacity"], when = blend_mode(True, False, True))
+# If both termo and visible contouring is on at the same time
+register_stage("blendContours", FusionPipeline.blendFrames, ["visibleHPF", "termoHPF"], settings = ["opacity"], when = blend_mode(True, True, False))
+# If all three buttons are on at the same time
+register_stage("blendContoursMap", FusionPipeline.blendMapped, ["visibleHPF", "termoHPF"], settings = ["opacity"], when = blend_mode(True, True, True))
@@ -0,0 +1,210 @@
+"""
+Description: benchmark of the whole path of a frame through the window, for every mode. The window is made under the
+Qt offscreen platform and fed by the synthetic cameras of the soak test, so it runs on a machine without cameras or
+a monitor (e.g. a CI box). Every frame goes the way of VideoLabel.update_frame, measured step by step on the GUI thread:
+
+    fuse        FusionPipeline.process_frame, reading the cameras and fusing the frame
+    views       composeViews, for the layouts with more than one view
+    image       wrapping the fused frame in a QImage (convert_cv_qt)
+    scale       QImage.scaled to the size of the video label
+    pixmap      QPixmap.fromImage
+    paint       setPixmap and painting the label
+    total       the real show_frame of the label and its painting, after fuse and views
+
+The fused frames are also handed to a VideoRecorder, as the Rec button does, and the frames the recorder thread
+encoded per second and dropped are reported for every mode.
+
+Example: "python guibench.py --frames 300" or "python guibench.py --modes Plain Pyramid --no-record".
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from soak import SOURCE_INDEX, SyntheticSource
+
+# Settings of every mode, on top of the default settings of the pair
+MODES = {
+    "Plain": {},
+    "Contour thermal": {"termo_flag": True},
+    "Contour visible": {"visible_flag": True},
+    "Color map": {"map_flag": True},
+    "Contour + map": {"termo_flag": True, "visible_flag": True, "map_flag": True},
+    "ThermaVue": {"vue_flag": True},
+    "Luminance": {"luma_flag": True},
+    "Pyramid": {"pyramid_flag": True},
+    "Statistics": {"map_flag": True, "stats_flag": True},
+    "Objects": {"vue_flag": True, "objects_flag": True},
+    "Fused Modes": {"views": ["fused", "blendMap", "thermaVue", "blendLuminance"]},
+}
+STEPS = ("fuse", "views", "image", "scale", "pixmap", "paint", "total")
+
+
+class GuiBench:
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.failures = []
+
+    def connect(self, app, video_label):
+        '''Lets the label open the synthetic cameras as it does with real ones, then stops its timer so the frames
+        are driven by the benchmark.
+        '''
+        deadline = time.perf_counter() + 30
+        while not video_label.timer.isActive():
+            if time.perf_counter() > deadline:
+                raise RuntimeError("the synthetic cameras did not connect")
+            app.processEvents()
+            time.sleep(0.01)
+        video_label.timer.stop()
+        video_label.pending.result()
+
+    def frame(self, app, video_label, times):
+        '''Takes one frame the way of update_frame, process_frame and show_frame, and notes the time of every step.
+        Returns the fused frame.
+        '''
+        from PyQt5 import QtGui
+        from PyQt5.QtCore import Qt
+        from PyQt5.QtGui import QPixmap
+        pipeline = video_label.pipeline
+        views = video_label.settings.views
+
+        t0 = time.perf_counter()
+        ret1, ret2, fusedFrame = pipeline.process_frame()
+        t1 = time.perf_counter()
+        viewFrame = fusedFrame
+        if fusedFrame is not None and len(views) > 1:
+            viewFrame = pipeline.composeViews(views, video_label.disply_width, video_label.display_height)
+        t2 = time.perf_counter()
+        if fusedFrame is None:
+            return None
+
+        # The steps of convert_cv_qt and setPixmap one by one
+        h, w, ch = viewFrame.shape
+        image = QtGui.QImage(viewFrame.data, w, h, ch * w, QtGui.QImage.Format_RGB888)
+        t3 = time.perf_counter()
+        scaled = image.scaled(video_label.disply_width, video_label.display_height, Qt.KeepAspectRatio)
+        t4 = time.perf_counter()
+        pixmap = QPixmap.fromImage(scaled)
+        t5 = time.perf_counter()
+        video_label.setPixmap(pixmap)
+        video_label.repaint()
+        t6 = time.perf_counter()
+
+        # The label itself, as the GUI thread runs it after a frame is ready
+        video_label.show_frame(ret1, ret2, fusedFrame, viewFrame)
+        video_label.repaint()
+        app.processEvents()
+        t7 = time.perf_counter()
+
+        for step, elapsed in zip(STEPS, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t6 - t5, t7 - t6 + t2 - t0)):
+            times[step].append(elapsed * 1000)
+        return fusedFrame
+
+    def run_mode(self, app, video_label, name):
+        from recorder import VideoRecorder
+        args = self.args
+        settings = video_label.settings
+        for flag in ("termo_flag", "visible_flag", "map_flag", "vue_flag", "luma_flag", "pyramid_flag", "stats_flag", "objects_flag"):
+            setattr(settings, flag, False)
+        settings.views = ["fused"]
+        for key, value in MODES[name].items():
+            setattr(settings, key, value)
+
+        times = {step: [] for step in STEPS}
+        for _ in range(args.warmup):
+            self.frame(app, video_label, {step: [] for step in STEPS})
+
+        recorder = None
+        if args.record:
+            recorder = VideoRecorder(os.path.join(self.folder, "bench.mp4"), 24, args.record_size)
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            fusedFrame = self.frame(app, video_label, times)
+            if recorder is not None and fusedFrame is not None:
+                recorder.write(fusedFrame, time.time())
+        if recorder is not None:
+            recorder.stop(wait = True)
+            recorded = len(recorder.timestamps) / (time.perf_counter() - start)
+            dropped = recorder.dropped
+            for file_name in os.listdir(self.folder):
+                os.remove(os.path.join(self.folder, file_name))
+        else:
+            recorded, dropped = None, None
+
+        means = {step: np.mean(values) if values else 0 for step, values in times.items()}
+        p95 = np.percentile(times["total"], 95) if times["total"] else 0
+        self.results.append((name, means, p95, recorded, dropped))
+        self.print_row(name, means, p95, recorded, dropped)
+        if args.max_ms is not None and means["total"] > args.max_ms:
+            self.failures.append(f"{name} takes {means['total']:.1f} ms per frame, the limit is {args.max_ms} ms")
+
+    def print_header(self):
+        steps = "".join(f"{step:>8}" for step in STEPS)
+        print(f"{'mode':<16}{steps}{'p95':>8}{'fps':>8}{'rec fps':>9}{'dropped':>9}")
+
+    def print_row(self, name, means, p95, recorded, dropped):
+        steps = "".join(f"{means[step]:8.2f}" for step in STEPS)
+        fps = 1000 / means["total"] if means["total"] else 0
+        recording = f"{recorded:9.1f}{dropped:9d}" if recorded is not None else f"{'-':>9}{'-':>9}"
+        print(f"{name:<16}{steps}{p95:8.2f}{fps:8.1f}{recording}", flush = True)
+
+    def run(self):
+        args = self.args
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt5 import QtWidgets
+        import variables
+        import fusion
+        import main
+
+        app = QtWidgets.QApplication(sys.argv[:1])
+        start = time.perf_counter()
+        # The sources have a frame ready whenever they are read, the pace is set by the benchmark
+        for index in (SOURCE_INDEX, SOURCE_INDEX + 1):
+            fusion.register_source(index, lambda index = index: SyntheticSource(args.source_fps, start, index == SOURCE_INDEX, seed = index))
+
+        self.folder = tempfile.mkdtemp(prefix = "fusion-guibench-")
+        variables.folder = self.folder
+        window = main.MainWindow(1)
+        video_label = window.video_labels[0]
+        settings = video_label.settings
+        settings.target_fps = args.target_fps
+        settings.termo = SOURCE_INDEX
+        settings.visible = SOURCE_INDEX + 1
+        window.show()
+        self.connect(app, video_label)
+
+        print(f"GUI path benchmark: label {video_label.disply_width}x{video_label.display_height}, "
+              f"{args.frames} frames per mode, times in ms", flush = True)
+        self.print_header()
+        try:
+            for name in args.modes:
+                self.run_mode(app, video_label, name)
+        finally:
+            video_label.stop()
+            shutil.rmtree(self.folder, ignore_errors = True)
+
+        if self.failures:
+            print("FAIL: " + "; ".join(self.failures), flush = True)
+        return not self.failures
+
+
+if __name__ == '__main__':
+    from recorder import parse_size
+    parser = argparse.ArgumentParser(description = "Benchmark of the display and recording path of the window, per mode, with synthetic cameras.")
+    parser.add_argument("--modes", nargs = "+", choices = MODES, default = list(MODES), metavar = "MODE",
+                        help = "modes to measure: " + ", ".join(f'"{name}"' for name in MODES))
+    parser.add_argument("--frames", type = int, default = 200, help = "frames measured per mode")
+    parser.add_argument("--warmup", type = int, default = 20, help = "frames before measuring each mode")
+    parser.add_argument("--source-fps", type = float, default = 1000, help = "frame rate of the synthetic cameras, high so reading never waits")
+    parser.add_argument("--target-fps", type = float, default = 0, help = "frame rate held by the adaptive quality, 0 measures the full quality")
+    parser.add_argument("--no-record", dest = "record", action = "store_false", help = "do not record the fused frames")
+    parser.add_argument("--record-size", type = parse_size, help = "size of the recording, e.g. 1280x960, by default the size of the fused frames")
+    parser.add_argument("--max-ms", type = float, help = "fail when a mode takes longer per frame on average")
+    args = parser.parse_args()
+    sys.exit(0 if GuiBench(args).run() else 1)
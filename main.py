@@ -6,254 +6,211 @@ Description: an interface which fuses thermal and visible cameras.
 
 """
 
+import time
+STARTUP_TIME = time.perf_counter()
+
 from PyQt5.QtWidgets import QWidget, QApplication, QLabel, QVBoxLayout
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtGui import QPalette
 from PyQt5.QtWidgets import *
 from PyQt5 import QtWidgets, QtGui, QtCore
 import sys
-import cv2
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt, QThread
-from PyQt5.QtMultimedia import QCameraInfo 
-import numpy as np
-from qt_material import apply_stylesheet
 from PyQt5.QtCore import QTimer
 import variables
+from themes import apply_theme
 import random
 import string
+import math
+import argparse
 
 ''' Global variables for button flags and opacity trackbar value.
 '''
-variables.opacity = 50
-variables.termo_flag = False
-variables.vue_flag = False
-variables.visible_flag =  False
-variables.map_flag = False
+variables.apply_defaults(variables)
 variables.record_flag = False
 variables.folder = None
 variables.file_name = None
-variables.picture = None
-variables.termo = None
-variables.visible = None
+variables.record_size = None
 variables.start = False
 
 
+# Processing rate of a pair while the window is minimised or hidden and the pair is not being recorded
+KEEP_ALIVE_INTERVAL = 1000
+FRAME_INTERVAL = 10
+
+# Layouts of the views combo box, see FusionPipeline.viewFrame for the view names
+VIEW_LAYOUTS = {
+    "Fused": ["fused"],
+    "Fused + Thermal": ["fused", "thermal"],
+    "Fused + Visible": ["fused", "visible"],
+    "Fused + Both Cameras": ["fused", "thermal", "visible"],
+    "Fused Modes": ["fused", "blendMap", "thermaVue", "blendLuminance"],
+}
+
+# Modes of the recording combo box and their sensitivity, the "On change" modes only keep the moments when the
+# thermal scene changes (see analytics.ThermalChangeDetector)
+RECORD_MODES = {
+    "Continuous": None,
+    "On Change (Low)": 25,
+    "On Change (Medium)": 50,
+    "On Change (High)": 75,
+}
+
+
 class VideoLabel(QtWidgets.QLabel):
-    def __init__(self, parent=None):
-        '''Initialises the video label. Connects to the cameras, sets the size of the window. 
+    frame_ready = pyqtSignal(bool, bool, object, object)
+    clicked = pyqtSignal()
+    camera_status = pyqtSignal(str)
+    connect_progress = pyqtSignal(str)
+    cameras_ready = pyqtSignal()
+
+    def __init__(self, parent=None, settings=variables, width=900, height=680):
+        '''Initialises the video label of one camera pair. Connects to the cameras, sets the size of the window.
+        The settings hold the flags of the pair, by default the global variables module.
         '''
         super(VideoLabel, self).__init__(parent)
-        self.disply_width = 900
-        self.display_height = 680
+        self.disply_width = width
+        self.display_height = height
         self.setFixedSize(self.disply_width, self.display_height)
         self.setStyleSheet("background-color: #3e4147;")
 
+        self.settings = settings
+        self.pipeline = None
+        self.pending = None
+        self.last_camera_status = None
+        self.display = True
+        self.interval = FRAME_INTERVAL
+        self.frame_ready.connect(self.show_frame)
+        self.connect_progress.connect(self.show_progress)
+        self.cameras_ready.connect(self.start_live_view)
+
         self.check_camera_timer = QtCore.QTimer(self)
         self.check_camera_timer.timeout.connect(self.check_camera_variables)
         self.check_camera_timer.start(10)
         
-        self.termoCamera = None
-        self.visibleCamera = None
-        
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.update_frame)
 
     def check_camera_variables(self):
         '''Check the camera variables and connect to cameras if available.
         '''
-        if variables.termo is not None and variables.visible is not None:
-            self.termoCamera, self.visibleCamera = self.connectToCameras()
-            self.check_camera_timer.stop()  
-            self.timer.start(10)  
-
-    def connectToCameras(self):
-        '''Connects to the cameras.
-        Output: camera1 and camera2.
-        Note: if it does not connect to the correct cameras, change the CAM1 and CAM2 constants to other indexes.
+        if self.settings.termo is not None and self.settings.visible is not None:
+            # OpenCV is only loaded once there is something to process
+            from fusion import FusionPipeline, get_worker_pool
+            self.worker_pool = get_worker_pool()
+            self.pipeline = FusionPipeline(self.settings)
+            self.check_camera_timer.stop()
+            # Opening and warming up the cameras takes seconds, the window stays responsive meanwhile
+            self.pending = self.worker_pool.submit(self.connect_cameras)
+
+    def connect_cameras(self):
+        '''Runs on a worker thread. Opens both cameras at the same time, throws away the first frames while the
+        cameras settle and prepares the processing, then starts the live view.
         '''
-        visible = cv2.VideoCapture(variables.termo, cv2.CAP_DSHOW)
-        termo = cv2.VideoCapture(variables.visible, cv2.CAP_DSHOW)
-        return visible, termo
+        from fusion import WARMUP_FRAMES
+        self.pipeline.connectToCameras(WARMUP_FRAMES, self.connect_progress.emit)
+        self.cameras_ready.emit()
 
-    def isCapturingFrames(self, ret1, ret2):
-        '''Checks if frames are captured correctly after obtaining a camera connection.
-        Gives an error message if there is a problem with camera captures.
-        '''
-
-        if not ret1 or not ret2:
-            error_message = "Failed to capture frames. One or both of the cameras are not connected properly."
-            msg_box = QMessageBox()
-            msg_box.setIcon(QMessageBox.Critical)
-            msg_box.setWindowTitle("Error")
-            msg_box.setText(error_message)
-            msg_box.setStandardButtons(QMessageBox.Close)
-            msg_box.buttonClicked.connect(lambda button: QApplication.quit())
-            
-            msg_box.exec_()
-            sys.exit(1)
-
-    def highPassFilter(self, frame):
-        '''High pass filter to contour the live video feed. It first applies Gaussian blur with 3x3 kernel, then applies the Sobel filter in x and y directions and calculates the square root of sum of squares. 
-        Input: a single frame
-        Output: a modified frame.
-        '''
-        yuvFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
-        gaussianFrame = cv2.GaussianBlur(yuvFrame, (5, 5), 0)
-        sobel_x = cv2.Sobel(gaussianFrame, cv2.CV_64F, 1, 0, ksize = 3)
-        sobel_y = cv2.Sobel(gaussianFrame, cv2.CV_64F, 0, 1, ksize = 3)
-        squaredSobel = np.sqrt( sobel_x**2 + sobel_y**2 )
-        squaredSobel = cv2.convertScaleAbs(squaredSobel)
-        res = cv2.cvtColor(squaredSobel, cv2.COLOR_BGR2RGB)
-        return res
-
-    def applyThermalColorMap(self, frame):
-        '''Applies the termal color mapping function from openCV to a current frame. The coloring is done based on pixel intensity.
-        Input: current frame.
-        Returns: colored frame.
-        '''
-        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        colormap = cv2.applyColorMap(gray_frame, cv2.COLORMAP_JET)
-        # colormap = 255 - colormap
-        colormap = cv2.GaussianBlur(colormap, (3, 3), 0)
-        return colormap
-
-    def pureThermalOnVisible(self, frame):
-        '''Thresholds a frame to achieve an image where the background is black and the objects are originally colored.
+    def show_progress(self, message):
+        '''Shows how far the connection of the cameras is, on the label until the first frame and on the status bar.
         '''
-        '''DEVELOPER NOTE: threshold value for ThermaVue function is in this code snippet. The current value is a 100. Adjust it if needed. cv2.threshold(gray_frame, VALUE, 255, cv2.THRESH_BINARY)[1]
+        self.setAlignment(Qt.AlignCenter)
+        self.setText(message)
+        self.camera_status.emit(message)
+
+    def start_live_view(self):
+        # The window may have been closed while the cameras were connecting
+        if self.pipeline.stopping.is_set():
+            return
+        self.camera_status.emit("Cameras connected.")
+        self.timer.start(self.interval)
+
+    def stop(self):
+        '''Stops the timers, waits for the frame which is still being processed and releases the cameras.
         '''
-        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        mask = cv2.threshold(gray_frame, 100, 255, cv2.THRESH_BINARY)[1]
-        inverted_mask = cv2.bitwise_not(mask)
-        black_background = np.zeros_like(frame)
-        result_frame = cv2.bitwise_and(frame, frame, mask = inverted_mask) + black_background
-        return result_frame
-
-    def toTransparentBackground(self, frame):
-        '''Replaces the black background with a transparent background.
+        self.check_camera_timer.stop()
+        self.timer.stop()
+        if self.pending is not None:
+            self.pending.exception()
+        if self.pipeline is not None:
+            self.pipeline.release()
+
+    def throttle(self, display, recording):
+        '''Adjusts the work of the pair to what is needed. A visible pair is processed and shown at full rate, a
+        hidden pair which is being recorded is processed at full rate without preparing the view, and a hidden pair
+        which is not recorded is only kept alive (cameras read, reconnects noticed) once a second.
         '''
-        temp = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        _, alpha = cv2.threshold(temp, 255, 0, cv2.THRESH_BINARY)
-        b, g, r = cv2.split(frame)
-        rgba = [b, g, r, alpha]
-        dst = cv2.merge(rgba)
-        return dst
-
-    def convert4Channel(self, frame):
-        '''Converts a 3-channel frame to a 4-channel frame. The 4th channel is required to regulate the opacity of the frame. 
+        self.display = display
+        self.interval = FRAME_INTERVAL if display or recording else KEEP_ALIVE_INTERVAL
+        if self.timer.isActive() and self.timer.interval() != self.interval:
+            self.timer.start(self.interval)
+
+    def mousePressEvent(self, event):
+        '''Lets the main window know which pair the user picked in the grid view.
         '''
-        b, g, r = cv2.split(frame)
-        alpha = np.full_like(b, 255, dtype = np.uint8)
-        return cv2.merge((b, g, r, alpha))
+        self.clicked.emit()
+        super(VideoLabel, self).mousePressEvent(event)
 
-    def toColoredObjects(self, frame):
-        '''Color maps the non-black/non-transparent pixels. Uses a JET color map for a realistic 'thermal' view.
+    def isCapturingFrames(self, ret1, ret2):
+        '''Checks if frames are captured correctly after obtaining a camera connection.
+        A camera which fails is reconnected by the pipeline in the background, meanwhile the label keeps showing
+        the last good frame and the status bar says what is happening with the cameras.
         '''
-        b, g, r, a = cv2.split(frame)
-        mask = np.any(frame[:, :, :3] != 0, axis = -1)
-        jet_colormap = cv2.applyColorMap(np.arange(256, dtype=np.uint8), cv2.COLORMAP_JET)
-        jet_colormap = jet_colormap
-        jet_colormap = cv2.GaussianBlur(jet_colormap, (5, 5), 0)
-        colored_pixels = jet_colormap[frame[:, :, 0], 0]
-
-        r[mask] = colored_pixels[mask, 2]
-        g[mask] = colored_pixels[mask, 1]
-        b[mask] = colored_pixels[mask, 0]
-        result_frame = cv2.merge((b, g, r, a))
-        
-        return result_frame
+        status = self.pipeline.camera_status
+        if status != self.last_camera_status:
+            self.last_camera_status = status
+            self.camera_status.emit(status)
+        return ret1 and ret2
 
     def update_frame(self):
-        '''Main logic of the program, controls the buttons and the view displayed on the video label.
+        '''Hands the next frame of this pair to the shared worker pool. A pair never has more than one frame
+        in flight, so a pair which falls behind skips timer ticks instead of queueing frames.
         '''
-        self.setStyleSheet("")
-        variables.start = True
-     
-        # Read the camera stream
-        ret1, visibleFrame = self.visibleCamera.read()
-        ret2, termoFrame = self.termoCamera.read()
-        
-        # Check if the frames are being captured
-        self.isCapturingFrames(ret1, ret2)
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            # Raise any error from the worker here, on the GUI thread
+            self.pending.result()
 
-        ''' DEVELOPER NOTE:
-            A horizontal flip for a visible camera, adjust as needed. Examples: 
-                visibleFrame = cv2.flip(visibleFrame, 1)  - horizontal flip for visible camera
-                termoFrame = cv2.flip(termoFrame, 1)  - horizontal flip for termo camera
-                termoFrame = cv2.flip(termoFrame, 0)  - vertical flip flip for termo camera   
+        self.pending = self.worker_pool.submit(self.process_frame)
+
+    def process_frame(self):
+        '''Runs on a worker thread. Reads and fuses one frame, then passes it to the GUI thread.
         '''
-        visibleFrame = cv2.flip(visibleFrame, 1)
-        
+        ret1, ret2, fusedFrame = self.pipeline.process_frame()
+        viewFrame = fusedFrame
+        views = self.settings.views
+        if fusedFrame is not None and self.display and len(views) > 1:
+            # All views come from the same camera grab and share the frames made for the fused one
+            viewFrame = self.pipeline.composeViews(views, self.disply_width, self.display_height)
+        self.frame_ready.emit(ret1, ret2, fusedFrame, viewFrame)
+
+    def show_frame(self, ret1, ret2, fusedFrame, viewFrame):
+        '''Main logic of the program on the GUI side, displays the fused frame, or the views of the pair next to
+        each other, on the video label.
+        '''
+        # Check if the frames are being captured, keep the last frame if there is no new one
+        self.isCapturingFrames(ret1, ret2)
+        if fusedFrame is None:
+            return
+        self.settings.frame = fusedFrame
+        if not self.display:
+            return
+
+        if self.styleSheet() != "":
+            self.setStyleSheet("")
+            self.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        variables.start = True
 
-        # Resize both frames to 640x480
-        termoFrame = cv2.resize(termoFrame, (640, 480))
-        visibleFrame = cv2.resize(visibleFrame, (640, 480))
-
-        # Creates two new frames with HPF applied. 
-        visibleHPFFrame = self.highPassFilter(visibleFrame) 
-        termoHPFFrame = self.highPassFilter(termoFrame)  
-
-        # Adjust the color space, so they all match each other
-        visibleFrame = cv2.cvtColor(visibleFrame, cv2.COLOR_BGR2RGB)
-        termoFrame = cv2.cvtColor(termoFrame, cv2.COLOR_BGR2RGB)
-        termoHPFFrame = cv2.cvtColor(termoHPFFrame, cv2.COLOR_BGR2RGB)
-
-        # Get the value of the opacity from the trackbar
-        opacity = variables.opacity / 100.0
-
-        # If thermaVue mode is of
-        if variables.vue_flag == False:
-            # If no buttons are pressed
-            if not variables.termo_flag and not variables.visible_flag and not variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleFrame, 1 - opacity, termoFrame, opacity, 0)
-            # If if map button is pressed
-            elif not variables.termo_flag and not variables.visible_flag and variables.map_flag:
-                mappedFrame = self.applyThermalColorMap(termoFrame)
-                fusedFrame = cv2.addWeighted(visibleFrame, 1 - opacity, mappedFrame, opacity, 0)
-            # If visible contouring is on
-            elif not variables.termo_flag and variables.visible_flag and not variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleHPFFrame, 1 - opacity, termoFrame, opacity, 0)
-            # If visible contour and color mapping is on at the same time
-            elif not variables.termo_flag and variables.visible_flag and variables.map_flag:
-                mappedFrame = self.applyThermalColorMap(termoFrame)
-                fusedFrame = cv2.addWeighted(visibleHPFFrame, 1 - opacity, mappedFrame, opacity, 0)
-            # If contour termo is on
-            elif variables.termo_flag and not variables.visible_flag and not variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleFrame, 1 - opacity, termoHPFFrame, opacity, 0)
-            # If contour termo and color mapping is on at the same time
-            elif variables.termo_flag and not variables.visible_flag and variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleFrame, 1 - opacity, termoHPFFrame, opacity, 0)
-                fusedFrame = self.applyThermalColorMap(fusedFrame)
-                fusedFrame = 255 - fusedFrame
-            # If both termo and visible contouring is on at the same time
-            elif variables.termo_flag and variables.visible_flag and not variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleHPFFrame, 1 - opacity, termoHPFFrame, opacity, 0)
-            # If all three buttons are on at the same time
-            elif variables.termo_flag and variables.visible_flag and variables.map_flag:
-                fusedFrame = cv2.addWeighted(visibleHPFFrame, 1 - opacity, termoHPFFrame, opacity, 0)
-                fusedFrame = self.applyThermalColorMap(fusedFrame)
-                fusedFrame = 255 - fusedFrame
-        # If thermaVue mode is on
-        elif variables.vue_flag == True:
-            bwFrame = self.pureThermalOnVisible(255 - termoFrame)
-            coloredBWFrame = self.applyThermalColorMap(bwFrame)  
-            transparentColoredBWFrame = self.toTransparentBackground(coloredBWFrame)
-            transparentBWFrame = self.toTransparentBackground(bwFrame) 
-            transparentRED = self.toColoredObjects(transparentBWFrame)
-            op1 = self.convert4Channel(visibleFrame)
-            op2 = transparentRED
-            fused = cv2.addWeighted(op2, 1, op1, 1, 0)
-            fusedFrame =  cv2.cvtColor(fused, cv2.COLOR_BGR2RGB)
-        
         # Convert the image from openCV format, to a format which can be processed with PyQT5
-        qt_img = self.convert_cv_qt(fusedFrame)
+        qt_img = self.convert_cv_qt(viewFrame)
         #Display the frame
         self.setPixmap(qt_img)
-        variables.picture = qt_img
+        self.settings.picture = qt_img
 
-    def convert_cv_qt(self, cv_img):
-        '''Convert from an opencv image to QPixmap'''
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+    def convert_cv_qt(self, rgb_image):
+        '''Convert from an opencv image to QPixmap. The pipeline already works in the RGB order of the QImage, so
+        the frame is used without a conversion.'''
         h, w, ch = rgb_image.shape
         bytes_per_line = ch * w
         convert_to_Qt_format = QtGui.QImage(rgb_image.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
@@ -262,6 +219,24 @@ class VideoLabel(QtWidgets.QLabel):
 
 
 
+class CameraEnumerator(QThread):
+    cameras_found = pyqtSignal(list)
+
+    def run(self):
+        '''Lists the available cameras once, on a background thread, so the window does not wait for the camera
+        drivers. QtMultimedia is only loaded here. Without a multimedia backend (e.g. a machine without audio
+        libraries, or the soak test and benchmark on a CI box) no camera is listed.
+        '''
+        try:
+            from PyQt5.QtMultimedia import QCameraInfo
+            cameras = [camera.description() for camera in QCameraInfo.availableCameras()]
+        except (ImportError, OSError) as error:
+            print(f"Cameras cannot be listed: {error}")
+            cameras = []
+        self.cameras_found.emit(cameras)
+
+
+
 class MainWindow(QtWidgets.QMainWindow):
     def trackbar_changed(self, value):
         '''Trackbar callback function. Displays the value of the trackbar on the status bar.
@@ -270,7 +245,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.status.showMessage("Cameras are not connected. Please connect before using controls.")
         else:
             self.status.showMessage(f'Trackbar Value: {value}')
-            variables.opacity = value
+            self.settings.opacity = value
 
     def termo_clicked(self):
         ''' Thermo button callback function. Updates the on/off flag and appearance'''
@@ -278,8 +253,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.status.showMessage("Cameras are not connected. Please connect before using controls.")
             self.button_termo.setChecked(False)
         else:    
-            variables.termo_flag = not variables.termo_flag
-            self.button_termo.setChecked(variables.termo_flag)
+            self.settings.termo_flag = not self.settings.termo_flag
+            self.button_termo.setChecked(self.settings.termo_flag)
    
     def visible_clicked(self):
         ''' Visible button callback function. Updates the on/off flag and appearance'''
@@ -287,8 +262,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.status.showMessage("Cameras are not connected. Please connect before using controls.")
             self.button_visible.setChecked(False)
         else:
-            variables.visible_flag = not variables.visible_flag
-            self.button_visible.setChecked(variables.visible_flag)
+            self.settings.visible_flag = not self.settings.visible_flag
+            self.button_visible.setChecked(self.settings.visible_flag)
 
     def map_clicked(self):
         ''' Map colour button callback function. Updates the on/off flag and appearance'''
@@ -297,13 +272,15 @@ class MainWindow(QtWidgets.QMainWindow):
             self.status.showMessage("Cameras are not connected. Please connect before using controls.")
             self.button_map.setChecked(False)
         else:
-            variables.map_flag = not variables.map_flag
-            self.button_map.setChecked(variables.map_flag)
+            self.settings.map_flag = not self.settings.map_flag
+            self.button_map.setChecked(self.settings.map_flag)
 
             # Disable other buttons
-            self.button_termo.setEnabled(not variables.map_flag)
-            self.button_visible.setEnabled(not variables.map_flag)
-            self.button_vue.setEnabled(not variables.map_flag)
+            self.button_termo.setEnabled(not self.settings.map_flag)
+            self.button_visible.setEnabled(not self.settings.map_flag)
+            self.button_vue.setEnabled(not self.settings.map_flag)
+            self.button_luma.setEnabled(not self.settings.map_flag)
+            self.button_pyramid.setEnabled(not self.settings.map_flag)
             self.button_termo.setChecked(False)
             self.button_visible.setChecked(False)
 
@@ -313,20 +290,156 @@ class MainWindow(QtWidgets.QMainWindow):
             self.status.showMessage("Cameras are not connected. Please connect before using controls.")
             self.button_vue.setChecked(False)
         else:
-            variables.vue_flag = not variables.vue_flag
-            self.button_vue.setChecked(variables.vue_flag)
+            self.settings.vue_flag = not self.settings.vue_flag
+            self.button_vue.setChecked(self.settings.vue_flag)
 
             # Disable the trackbar
-            self.trackbar.setEnabled(not variables.vue_flag) 
+            self.trackbar.setEnabled(not self.settings.vue_flag) 
             self.trackbar.setStyleSheet("padding:10px 227px 10px 227px; QSlider::sub-page:disabled { background-color: gray; }")
 
             # Disable other buttons
-            self.button_termo.setEnabled(not variables.vue_flag)
-            self.button_visible.setEnabled(not variables.vue_flag)
-            self.button_map.setEnabled(not variables.vue_flag)
+            self.button_termo.setEnabled(not self.settings.vue_flag)
+            self.button_visible.setEnabled(not self.settings.vue_flag)
+            self.button_map.setEnabled(not self.settings.vue_flag)
+            self.button_luma.setEnabled(not self.settings.vue_flag)
+            self.button_pyramid.setEnabled(not self.settings.vue_flag)
             self.button_termo.setChecked(False)
             self.button_visible.setChecked(False)
 
+    def luma_clicked(self):
+        ''' Luminance button callback function. Blends the thermal frame into the brightness of the visible frame only,
+        the visible colours are kept. '''
+        if not self.ter_connected or not self.vi_connected:
+            self.status.showMessage("Cameras are not connected. Please connect before using controls.")
+            self.button_luma.setChecked(False)
+        else:
+            self.settings.luma_flag = not self.settings.luma_flag
+            self.button_luma.setChecked(self.settings.luma_flag)
+
+            # Disable other buttons
+            self.button_termo.setEnabled(not self.settings.luma_flag)
+            self.button_visible.setEnabled(not self.settings.luma_flag)
+            self.button_map.setEnabled(not self.settings.luma_flag)
+            self.button_vue.setEnabled(not self.settings.luma_flag)
+            self.button_pyramid.setEnabled(not self.settings.luma_flag)
+            self.button_termo.setChecked(False)
+            self.button_visible.setChecked(False)
+
+    def pyramid_clicked(self):
+        ''' Pyramid button callback function. Fuses the thermal frame into the brightness of the visible frame scale by
+        scale, keeping the stronger detail of the two cameras. '''
+        if not self.ter_connected or not self.vi_connected:
+            self.status.showMessage("Cameras are not connected. Please connect before using controls.")
+            self.button_pyramid.setChecked(False)
+        else:
+            self.settings.pyramid_flag = not self.settings.pyramid_flag
+            self.button_pyramid.setChecked(self.settings.pyramid_flag)
+
+            # Disable other buttons
+            self.button_termo.setEnabled(not self.settings.pyramid_flag)
+            self.button_visible.setEnabled(not self.settings.pyramid_flag)
+            self.button_map.setEnabled(not self.settings.pyramid_flag)
+            self.button_vue.setEnabled(not self.settings.pyramid_flag)
+            self.button_luma.setEnabled(not self.settings.pyramid_flag)
+            self.button_termo.setChecked(False)
+            self.button_visible.setChecked(False)
+
+    def stats_clicked(self):
+        ''' Statistics button callback function. Shows the thermal min/max/mean and the hottest point on the live view.
+        If a save directory is selected, the statistics are also written to a CSV file there. '''
+        if not self.ter_connected or not self.vi_connected:
+            self.status.showMessage("Cameras are not connected. Please connect before using controls.")
+            self.button_stats.setChecked(False)
+        else:
+            self.settings.stats_flag = not self.settings.stats_flag
+            self.button_stats.setChecked(self.settings.stats_flag)
+
+            if self.settings.stats_flag and variables.folder:
+                file_name = variables.file_name if variables.file_name else "fusionStats"
+                random_string = ''.join(random.choice(string.digits) for _ in range(4))
+                self.settings.stats_log = f"{variables.folder}/{file_name}_{random_string}.csv"
+                self.status.showMessage(f"Thermal statistics are saved to {self.settings.stats_log}")
+            else:
+                self.settings.stats_log = None
+
+    def objects_clicked(self):
+        ''' Objects button callback function. Marks the warm objects (the areas ThermaVue colours) with their boxes on
+        the live view. If a save directory is selected, the objects are also written to a CSV file there. '''
+        if not self.ter_connected or not self.vi_connected:
+            self.status.showMessage("Cameras are not connected. Please connect before using controls.")
+            self.button_objects.setChecked(False)
+        else:
+            self.settings.objects_flag = not self.settings.objects_flag
+            self.button_objects.setChecked(self.settings.objects_flag)
+
+            if self.settings.objects_flag and variables.folder:
+                file_name = variables.file_name if variables.file_name else "fusionObjects"
+                random_string = ''.join(random.choice(string.digits) for _ in range(4))
+                self.settings.objects_log = f"{variables.folder}/{file_name}_objects_{random_string}.csv"
+                self.status.showMessage(f"Warm objects are saved to {self.settings.objects_log}")
+            else:
+                self.settings.objects_log = None
+
+    def agc_clicked(self):
+        ''' Auto Gain button callback function. Stretches the thermal contrast to the current scene. '''
+        if not self.ter_connected or not self.vi_connected:
+            self.status.showMessage("Cameras are not connected. Please connect before using controls.")
+            self.button_agc.setChecked(False)
+        else:
+            self.settings.agc_flag = not self.settings.agc_flag
+            self.button_agc.setChecked(self.settings.agc_flag)
+
+    def threshold_selected(self, index):
+        ''' A callback function for the ThermaVue threshold combo box. '''
+        self.settings.threshold_mode = self.sender().currentText()
+
+    def choose_threshold(self, other_info):
+        ''' Creates a combo box to choose how the ThermaVue threshold is set: the fixed value or computed from the
+        thermal histogram of the scene. '''
+        combo_box = QComboBox()
+        combo_box.setFixedSize(200, 30)
+        combo_box.setStyleSheet("QComboBox { color: gray; } QComboBox QAbstractItemView { color: gray; } QComboBox::item:selected { background-color: gray; }")
+        combo_box.addItem("Fixed")
+        combo_box.addItem("Otsu")
+        combo_box.addItem("Hottest 5%")
+        other_info.addWidget(combo_box)
+        combo_box.currentIndexChanged.connect(self.threshold_selected)
+        self.threshold_combo = combo_box
+
+    def views_selected(self, index):
+        ''' A callback function for the views combo box. '''
+        self.settings.views = VIEW_LAYOUTS[self.sender().currentText()]
+
+    def choose_views(self, layout):
+        ''' Creates a combo box to show the fused frame alone or next to the camera frames or other modes. All
+        views of a pair are made from the same camera frames. '''
+        combo_box = QComboBox()
+        combo_box.setFixedSize(200, 30)
+        combo_box.setStyleSheet("QComboBox { color: gray; } QComboBox QAbstractItemView { color: gray; } QComboBox::item:selected { background-color: gray; }")
+        for name in VIEW_LAYOUTS:
+            combo_box.addItem(name)
+        layout.addWidget(combo_box)
+        combo_box.currentIndexChanged.connect(self.views_selected)
+        self.views_combo = combo_box
+
+    def record_mode_selected(self, index):
+        ''' A callback function for the recording combo box. '''
+        sensitivity = RECORD_MODES[self.sender().currentText()]
+        self.settings.trigger_flag = sensitivity is not None
+        if sensitivity is not None:
+            self.settings.trigger_sensitivity = sensitivity
+
+    def choose_record_mode(self, layout):
+        ''' Creates a combo box to record continuously or only while the thermal scene changes. '''
+        combo_box = QComboBox()
+        combo_box.setFixedSize(200, 30)
+        combo_box.setStyleSheet("QComboBox { color: gray; } QComboBox QAbstractItemView { color: gray; } QComboBox::item:selected { background-color: gray; }")
+        for name in RECORD_MODES:
+            combo_box.addItem(name)
+        layout.addWidget(combo_box)
+        combo_box.currentIndexChanged.connect(self.record_mode_selected)
+        self.record_mode_combo = combo_box
+
     def save_picture(self):
         ''' Saves the snapshot to specified directory + file name. If the directory is not specified a user gets propmpted with an error message. If a user doesn't update the file prefix, the picture is saved with a default name.
         '''
@@ -335,7 +448,7 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             file_path = variables.folder
             file_name = variables.file_name
-            picture = variables.picture
+            picture = self.settings.picture
 
             characters =  string.digits
             random_string = ''.join(random.choice(characters) for _ in range(4))
@@ -369,27 +482,73 @@ class MainWindow(QtWidgets.QMainWindow):
         self.button_termo = QtWidgets.QPushButton("Contour Thermal") 
         self.button_termo.setFixedSize(200, 50)
         self.button_termo.setCheckable(True)  
-        self.button_termo.setChecked(variables.termo_flag)  
+        self.button_termo.setChecked(self.settings.termo_flag)  
         self.button_termo.clicked.connect(self.termo_clicked) 
 
         self.button_visible = QtWidgets.QPushButton("Contour Visible")
         self.button_visible.setFixedSize(200, 50)
         self.button_visible.setCheckable(True)
-        self.button_visible.setChecked(variables.visible_flag)
+        self.button_visible.setChecked(self.settings.visible_flag)
         self.button_visible.clicked.connect(self.visible_clicked)
 
         self.button_map = QtWidgets.QPushButton("Color Thermal")
         self.button_map.setFixedSize(200, 50)
         self.button_map.setCheckable(True)
-        self.button_map.setChecked(variables.map_flag)
+        self.button_map.setChecked(self.settings.map_flag)
         self.button_map.clicked.connect(self.map_clicked)
 
         self.button_vue = QtWidgets.QPushButton("ThermaVue")
         self.button_vue.setFixedSize(200, 50)
         self.button_vue.setCheckable(True)
-        self.button_vue.setChecked(variables.vue_flag)
+        self.button_vue.setChecked(self.settings.vue_flag)
         self.button_vue.clicked.connect(self.vue_clicked)
 
+        self.button_luma = QtWidgets.QPushButton("Luminance")
+        self.button_luma.setFixedSize(98, 50)
+        self.button_luma.setCheckable(True)
+        self.button_luma.setChecked(self.settings.luma_flag)
+        self.button_luma.clicked.connect(self.luma_clicked)
+
+        self.button_pyramid = QtWidgets.QPushButton("Pyramid")
+        self.button_pyramid.setFixedSize(98, 50)
+        self.button_pyramid.setCheckable(True)
+        self.button_pyramid.setChecked(self.settings.pyramid_flag)
+        self.button_pyramid.clicked.connect(self.pyramid_clicked)
+
+        # The two blends which work on the visible brightness share a row, without the side padding of the theme
+        for button in (self.button_luma, self.button_pyramid):
+            button.setStyleSheet("padding-left: 0px; padding-right: 0px;")
+        blend_layout = QtWidgets.QHBoxLayout()
+        blend_layout.setSpacing(4)
+        blend_layout.addWidget(self.button_luma)
+        blend_layout.addWidget(self.button_pyramid)
+
+        self.button_stats = QtWidgets.QPushButton("Statistics")
+        self.button_stats.setFixedSize(98, 50)
+        self.button_stats.setCheckable(True)
+        self.button_stats.setChecked(self.settings.stats_flag)
+        self.button_stats.clicked.connect(self.stats_clicked)
+
+        self.button_objects = QtWidgets.QPushButton("Objects")
+        self.button_objects.setFixedSize(98, 50)
+        self.button_objects.setCheckable(True)
+        self.button_objects.setChecked(self.settings.objects_flag)
+        self.button_objects.clicked.connect(self.objects_clicked)
+
+        # The two thermal overlays share a row like the two blends
+        for button in (self.button_stats, self.button_objects):
+            button.setStyleSheet("padding-left: 0px; padding-right: 0px;")
+        overlay_layout = QtWidgets.QHBoxLayout()
+        overlay_layout.setSpacing(4)
+        overlay_layout.addWidget(self.button_stats)
+        overlay_layout.addWidget(self.button_objects)
+
+        self.button_agc = QtWidgets.QPushButton("Auto Gain")
+        self.button_agc.setFixedSize(200, 50)
+        self.button_agc.setCheckable(True)
+        self.button_agc.setChecked(self.settings.agc_flag)
+        self.button_agc.clicked.connect(self.agc_clicked)
+
         controls_layout.addWidget(self.button_termo)
         controls_layout.addWidget(self.create_spacer(10, 3))
         controls_layout.addWidget(self.button_visible)
@@ -397,6 +556,18 @@ class MainWindow(QtWidgets.QMainWindow):
         controls_layout.addWidget(self.button_map)
         controls_layout.addWidget(self.create_spacer(10, 3))
         controls_layout.addWidget(self.button_vue)
+        controls_layout.addWidget(self.create_spacer(10, 3))
+        controls_layout.addLayout(blend_layout)
+        controls_layout.addWidget(self.create_spacer(10, 3))
+        controls_layout.addLayout(overlay_layout)
+        controls_layout.addWidget(self.create_spacer(10, 3))
+        controls_layout.addWidget(self.button_agc)
+        controls_layout.addWidget(self.create_spacer(10, 10))
+        self.theme_label(controls_layout, "VIEWS")
+        self.choose_views(controls_layout)
+        controls_layout.addWidget(self.create_spacer(10, 10))
+        self.theme_label(controls_layout, "RECORDING")
+        self.choose_record_mode(controls_layout)
 
     def create_control_buttons(self, save_rec_layout):
         ''' Creates two more buttons for saving a snapshot and recording a video.
@@ -414,6 +585,22 @@ class MainWindow(QtWidgets.QMainWindow):
         save_rec_layout.addWidget(self.button_save)
         save_rec_layout.addWidget(self.button_record)
 
+    def create_playback_button(self, other_info):
+        ''' Creates a button which opens a recording in the playback window. '''
+        self.button_playback = QtWidgets.QPushButton("Open Recording")
+        self.button_playback.setFixedSize(200, 30)
+        self.button_playback.clicked.connect(self.open_recording)
+        other_info.addWidget(self.button_playback)
+
+    def open_recording(self):
+        ''' Playback button callback function. Lets the user pick a recording and plays it in a separate window. '''
+        start_folder = variables.folder if variables.folder else ""
+        video_path, _ = QFileDialog.getOpenFileName(self, "Open Recording", start_folder, "Videos (*.mp4)")
+        if video_path:
+            from playback import PlaybackWindow
+            self.playback_window = PlaybackWindow(video_path, self)
+            self.playback_window.show()
+
     def create_logo_label(self, controls_layout):
         ''' Creates a logo label which displayes Ados-Tech logo from an image image.jpg
         '''
@@ -442,6 +629,22 @@ class MainWindow(QtWidgets.QMainWindow):
         self.status.showMessage('Waiting for camera connection..')
         bottom_layout.addWidget(self.status)
 
+        # The quality level of the selected pair and the time between its two cameras taking their frames
+        self.quality_label = QtWidgets.QLabel()
+        self.status.addPermanentWidget(self.quality_label)
+        self.skew_label = QtWidgets.QLabel()
+        self.status.addPermanentWidget(self.skew_label)
+        self.skew_timer = QTimer(self)
+        self.skew_timer.timeout.connect(self.update_skew_label)
+        self.skew_timer.start(500)
+
+    def update_skew_label(self):
+        ''' Shows the quality level and the camera skew of the selected pair on the status bar. '''
+        skew = self.settings.skew
+        self.skew_label.setText("" if skew is None else f"Camera skew {skew.mean:.1f} ms (max {skew.max:.1f} ms)")
+        quality = "" if skew is None or not self.settings.target_fps else f"Quality: {self.settings.quality}"
+        self.quality_label.setText(quality)
+
     def create_spacer(self, w, h):
         ''' A function to get a universal spacer. Makes an empty label of the dimentions w - width, h - height. 
         '''
@@ -461,11 +664,13 @@ class MainWindow(QtWidgets.QMainWindow):
     
         # Change the empty video_label appearance & logo according to theme (light/dark)
         if selected_option[0] ==  "D":
-            self.video_label.setStyleSheet("background-color: #3e4147;")
+            for video_label in self.video_labels:
+                video_label.setStyleSheet("background-color: #3e4147;")
             self.change_logo_image("white.png")
 
         elif selected_option[0] == "L":
-            self.video_label.setStyleSheet("background-color: #c4c4c4;")
+            for video_label in self.video_labels:
+                video_label.setStyleSheet("background-color: #c4c4c4;")
             self.change_logo_image("black.png")
 
         else:
@@ -473,58 +678,58 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
         if selected_option == "Dark Amber":
-            apply_stylesheet(self, theme = 'dark_amber.xml')
+            apply_theme(self, theme = 'dark_amber.xml')
 
         elif selected_option == "Dark Blue":
-            apply_stylesheet(self, theme = 'dark_blue.xml')
+            apply_theme(self, theme = 'dark_blue.xml')
 
         elif selected_option == "Dark Light Green":
-            apply_stylesheet(self, theme = 'dark_lightgreen.xml')
+            apply_theme(self, theme = 'dark_lightgreen.xml')
 
         elif selected_option == "Dark Pink":
-            apply_stylesheet(self, theme = 'dark_pink.xml')
+            apply_theme(self, theme = 'dark_pink.xml')
 
         elif selected_option == "Dark Purple":
-            apply_stylesheet(self, theme = 'dark_purple.xml')
+            apply_theme(self, theme = 'dark_purple.xml')
 
         elif selected_option == "Dark Red":
-            apply_stylesheet(self, theme = 'dark_red.xml')
+            apply_theme(self, theme = 'dark_red.xml')
 
         elif selected_option == "Dark Teal":
-            apply_stylesheet(self, theme = 'dark_teal.xml')
+            apply_theme(self, theme = 'dark_teal.xml')
 
         elif selected_option == "Dark Yellow":
-            apply_stylesheet(self, theme = 'dark_yellow.xml')
+            apply_theme(self, theme = 'dark_yellow.xml')
 
         elif selected_option == "Light Amber":
-            apply_stylesheet(self, theme = 'light_amber.xml')
+            apply_theme(self, theme = 'light_amber.xml')
 
         elif selected_option == "Light Blue":
-            apply_stylesheet(self, theme = 'light_blue.xml')
+            apply_theme(self, theme = 'light_blue.xml')
 
         elif selected_option == "Light Cyan":
-            apply_stylesheet(self, theme = 'light_cyan.xml')
+            apply_theme(self, theme = 'light_cyan.xml')
 
         elif selected_option == "Dark Cyan":
-            apply_stylesheet(self, theme = 'dark_cyan.xml')
+            apply_theme(self, theme = 'dark_cyan.xml')
 
         elif selected_option == "Light Light Green":
-            apply_stylesheet(self, theme = 'light_lightgreen.xml')
+            apply_theme(self, theme = 'light_lightgreen.xml')
 
         elif selected_option == "Light Pink":
-            apply_stylesheet(self, theme = 'light_pink.xml')
+            apply_theme(self, theme = 'light_pink.xml')
 
         elif selected_option == "Light Purple":
-            apply_stylesheet(self, theme = 'light_purple.xml')
+            apply_theme(self, theme = 'light_purple.xml')
 
         elif selected_option == "Light Red":
-            apply_stylesheet(self, theme = 'light_red.xml')
+            apply_theme(self, theme = 'light_red.xml')
 
         elif selected_option == "Light Teal":
-            apply_stylesheet(self, theme = 'light_teal.xml')
+            apply_theme(self, theme = 'light_teal.xml')
 
         elif selected_option == "Light Yellow":
-            apply_stylesheet(self, theme = 'light_yellow.xml')
+            apply_theme(self, theme = 'light_yellow.xml')
 
     def choose_theme(self, other_info):
         ''' Creates a combo box which allows the user to choose from various color themes. 
@@ -591,57 +796,80 @@ class MainWindow(QtWidgets.QMainWindow):
         combo_box = QComboBox()
         combo_box.setStyleSheet("QComboBox { color: gray; } QComboBox QAbstractItemView { color: gray; } QComboBox::item:selected { background-color: gray; }")
         combo_box.setFixedSize(200, 30)
-        available_cameras = QCameraInfo.availableCameras()
-        combo_box.addItem("")
-        if available_cameras:
-            for idx, camera in enumerate(available_cameras):
-                camera_name_with_index = f"{idx + 1}: {camera.description()}"
-                combo_box.addItem(camera_name_with_index, camera)
-        else:
-            combo_box.addItem("No cameras found")
+        combo_box.addItem("Searching for cameras...")
+        combo_box.setEnabled(False)
         
         other_info.addWidget(combo_box)
         combo_box.currentIndexChanged.connect(self.handle_termo)
+        self.termo_combo = combo_box
 
     def combo_box_for_visible(self, other_info):
         combo_box = QComboBox()
         combo_box.setStyleSheet("QComboBox { color: gray; } QComboBox QAbstractItemView { color: gray; } QComboBox::item:selected { background-color: gray; }")
         combo_box.setFixedSize(200, 30)
-        available_cameras = QCameraInfo.availableCameras()
-        combo_box.addItem("")
-        if available_cameras:
-            for idx, camera in enumerate(available_cameras):
-                camera_name_with_index = f"{idx + 1}: {camera.description()}"
-                combo_box.addItem(camera_name_with_index, camera)
-        else:
-            combo_box.addItem("No cameras found")
+        combo_box.addItem("Searching for cameras...")
+        combo_box.setEnabled(False)
         
         other_info.addWidget(combo_box)
         combo_box.currentIndexChanged.connect(self.handle_visible)
+        self.visible_combo = combo_box
+
+    def fill_camera_combo_boxes(self, cameras):
+        ''' Camera enumeration callback. Fills both camera combo boxes from the same list of cameras. '''
+        for combo_box in (self.termo_combo, self.visible_combo):
+            combo_box.blockSignals(True)
+            combo_box.clear()
+            combo_box.addItem("")
+            if cameras:
+                for idx, camera in enumerate(cameras):
+                    camera_name_with_index = f"{idx + 1}: {camera}"
+                    combo_box.addItem(camera_name_with_index)
+            else:
+                combo_box.addItem("No cameras found")
+            combo_box.setEnabled(True)
+            combo_box.blockSignals(False)
+        self.sync_controls()
 
     def handle_visible(self, index):
-        self.vi_connected = True
         selected_option = self.sender().currentText()
         if selected_option != "":
-            if self.ter_connected == False:
+            self.settings.visible = int(selected_option[0]) - 1
+            # A running pair switches to the new device in the background
+            if self.video_label.pipeline is not None:
+                self.status.showMessage('Switching the visible camera ...')
+            elif self.ter_connected == False:
                 self.status.showMessage('Connected to Visible Camera. Cameras connected 1/2 ...')
             else:
                 self.status.showMessage('Connection to both cameras is successful.')
-            variables.visible = int(selected_option[0]) - 1
 
     def handle_termo(self):
-        self.ter_connected = True
         selected_option = self.sender().currentText()
         if selected_option != "":
-            if self.vi_connected == False:
+            self.settings.termo = int(selected_option[0]) - 1
+            # A running pair switches to the new device in the background
+            if self.video_label.pipeline is not None:
+                self.status.showMessage('Switching the thermal camera ...')
+            elif self.vi_connected == False:
                 self.status.showMessage('Connected to Thermal Camera. Cameras connected 1/2 ...')
             else:
                 self.status.showMessage('Connection to both cameras is successful.')
-            variables.termo = int(selected_option[0]) - 1
 
     def record_frame(self):
-        current_frame = variables.picture 
-        self.frames.append(current_frame)
+        # The fused frame of the pipeline, so recording does not depend on the view being drawn or its size
+        current_frame = self.recording_settings.frame 
+        if current_frame is None:
+            return
+        if not self.recording_settings.trigger_flag:
+            self.recorder.write(current_frame, time.time())
+            return
+
+        # Only the moments when the thermal scene changes are kept, with a few seconds before and after
+        kept = self.change_gate.push(current_frame, time.time(), self.recording_settings.last_change)
+        for frame, timestamp in kept:
+            self.recorder.write(frame, timestamp)
+        if bool(kept) != self.recording_change:
+            self.recording_change = bool(kept)
+            self.status.showMessage("Recording the thermal change ..." if kept else "Recording paused until the thermal scene changes.")
 
     def toggle_video_recording(self):
         if not self.ter_connected or not self.vi_connected:
@@ -668,6 +896,23 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def stop_video_recording(self):
         self.recording = False
+        self.video_timer.stop()
+        self.update_throttling()
+        # The recorder thread writes the frames still waiting and the frame index, the window does not wait for it
+        self.recorder.stop()
+
+        message_box = QMessageBox()
+        message_box.setWindowTitle("Picture Saved")
+        if self.recorder.frames > 0:
+            message_box.setText(f"Picture saved at:\n{self.recorder.path}")
+        else:
+            message_box.setText("Nothing was recorded, the thermal scene did not change.")
+        message_box.setIcon(QMessageBox.Information)
+        message_box.exec_()     
+
+    def start_video_recording(self):
+        from analytics import ChangeGate
+        from recorder import VideoRecorder
         file_path = variables.folder
         file_name = variables.file_name
 
@@ -681,46 +926,143 @@ class MainWindow(QtWidgets.QMainWindow):
             file_name = file_name + "_" + random_string
 
         full_file_path = f"{file_path}/{file_name}.mp4"
-    
-        if len(self.frames) > 0:
-            height, width = self.frames[0].height(), self.frames[0].width()
-    
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(full_file_path, fourcc, 24, (width, height))
-            for frame in self.frames:
-                frame_np = self.qPixmapToMat(frame)
-                out.write(frame_np)
-
-            out.release()
-
-        message_box = QMessageBox()
-        message_box.setWindowTitle("Picture Saved")
-        message_box.setText(f"Picture saved at:\n{full_file_path}")
-        message_box.setIcon(QMessageBox.Information)
-        message_box.exec_()     
-
-    def qPixmapToMat(self, pixmap):
-        qimage = pixmap.toImage()
-        width, height = qimage.width(), qimage.height()
-        ptr = qimage.bits()
-        ptr.setsize(qimage.byteCount())
-        arr = np.array(ptr).reshape(height, width, 4)  
-        return cv2.cvtColor(arr, cv2.COLOR_RGBA2BGR) 
 
-    def start_video_recording(self):
         self.recording = True
-        self.frames = [] 
+        self.recording_settings = self.settings
+        self.recording_label = self.video_label
+        # The video has the size of the fused frames unless a size is set with --record-size, whatever the size of the view
+        self.recorder = VideoRecorder(full_file_path, 24, variables.record_size)
+        self.change_gate = ChangeGate(self.settings.trigger_pre, self.settings.trigger_post, 24)
+        self.recording_change = None
         self.video_timer.start(int(1000 /24))  
+        self.update_throttling()
         
-    def __init__(self):
+    @property
+    def settings(self):
+        ''' The flags of the camera pair which the controls currently act on. '''
+        return self.video_label.settings
+
+    @property
+    def ter_connected(self):
+        return self.settings.termo is not None
+
+    @property
+    def vi_connected(self):
+        return self.settings.visible is not None
+
+    def create_video_grid(self, central_widget, pairs, frame_bus = None):
+        ''' Creates one video label per camera pair. A single pair fills the whole video area, several pairs
+        share it in a grid. The first pair uses the global variables, every other pair gets its own settings.
+        With a frame bus name, pair n publishes its frames as <name>n (see framebus.py).
+        '''
+        columns = math.ceil(math.sqrt(pairs))
+        rows = math.ceil(pairs / columns)
+        width = 900 // columns
+        height = 680 // rows
+
+        self.video_labels = []
+        self.video_grid = QtWidgets.QGridLayout()
+        self.video_grid.setSpacing(0)
+        for idx in range(pairs):
+            settings = variables if idx == 0 else variables.PairSettings()
+            settings.frame_bus = f"{frame_bus}{idx}" if frame_bus else None
+            video_label = VideoLabel(central_widget, settings, width, height)
+            video_label.clicked.connect(lambda idx = idx: self.select_pair(idx))
+            video_label.camera_status.connect(lambda message, idx = idx: self.show_camera_status(idx, message))
+            self.video_grid.addWidget(video_label, idx // columns, idx % columns)
+            self.video_labels.append(video_label)
+
+        self.video_label = self.video_labels[0]
+        if pairs > 1:
+            from fusion import configure_threads
+            configure_threads(pairs)
+
+    def show_camera_status(self, idx, message):
+        ''' Shows what is happening with the cameras of a pair (lost, reconnecting, connected) on the status bar. '''
+        if len(self.video_labels) > 1:
+            message = f'Camera pair {idx + 1}: {message}'
+        self.status.showMessage(message)
+
+    def select_pair(self, idx):
+        ''' Grid view callback. Makes the clicked pair the one the controls act on. '''
+        self.video_label = self.video_labels[idx]
+        for video_label in self.video_labels:
+            video_label.setFrameStyle(QtWidgets.QFrame.Box if video_label is self.video_label else QtWidgets.QFrame.NoFrame)
+        self.sync_controls()
+        self.status.showMessage(f'Camera pair {idx + 1} selected.')
+
+    def sync_controls(self):
+        ''' Shows the flags of the selected pair on the buttons, the trackbar and the camera combo boxes. '''
+        settings = self.settings
+        widgets = [self.termo_combo, self.visible_combo, self.trackbar,
+                   self.button_termo, self.button_visible, self.button_map, self.button_vue, self.button_luma,
+                   self.button_pyramid, self.button_stats, self.button_objects, self.button_agc, self.threshold_combo, self.views_combo,
+                   self.record_mode_combo]
+        for widget in widgets:
+            widget.blockSignals(True)
+
+        self.termo_combo.setCurrentIndex(0 if settings.termo is None else settings.termo + 1)
+        self.visible_combo.setCurrentIndex(0 if settings.visible is None else settings.visible + 1)
+        self.trackbar.setValue(settings.opacity)
+        self.trackbar.setEnabled(not settings.vue_flag)
+        self.button_termo.setChecked(settings.termo_flag)
+        self.button_visible.setChecked(settings.visible_flag)
+        self.button_map.setChecked(settings.map_flag)
+        self.button_vue.setChecked(settings.vue_flag)
+        self.button_luma.setChecked(settings.luma_flag)
+        self.button_pyramid.setChecked(settings.pyramid_flag)
+        self.button_stats.setChecked(settings.stats_flag)
+        self.button_objects.setChecked(settings.objects_flag)
+        self.button_agc.setChecked(settings.agc_flag)
+        self.threshold_combo.setCurrentText(settings.threshold_mode)
+        self.views_combo.setCurrentText(next(name for name, views in VIEW_LAYOUTS.items() if views == settings.views))
+        self.record_mode_combo.setCurrentText(next(name for name, sensitivity in RECORD_MODES.items()
+                                                   if sensitivity == (settings.trigger_sensitivity if settings.trigger_flag else None)))
+        blend = settings.luma_flag or settings.pyramid_flag
+        self.button_termo.setEnabled(not settings.vue_flag and not settings.map_flag and not blend)
+        self.button_visible.setEnabled(not settings.vue_flag and not settings.map_flag and not blend)
+        self.button_map.setEnabled(not settings.vue_flag and not blend)
+        self.button_vue.setEnabled(not settings.map_flag and not blend)
+        self.button_luma.setEnabled(not settings.vue_flag and not settings.map_flag and not settings.pyramid_flag)
+        self.button_pyramid.setEnabled(not settings.vue_flag and not settings.map_flag and not settings.luma_flag)
+
+        for widget in widgets:
+            widget.blockSignals(False)
+
+    def update_throttling(self):
+        ''' Tells every pair whether its frames are shown and whether it is being recorded. '''
+        display = self.isVisible() and not self.isMinimized()
+        for video_label in self.video_labels:
+            video_label.throttle(display, self.recording and video_label is self.recording_label)
+
+    def changeEvent(self, event):
+        ''' Slows the pairs down while the window is minimised and back up when it is restored. '''
+        if event.type() == QtCore.QEvent.WindowStateChange:
+            self.update_throttling()
+        super(MainWindow, self).changeEvent(event)
+
+    def showEvent(self, event):
+        super(MainWindow, self).showEvent(event)
+        self.update_throttling()
+
+    def hideEvent(self, event):
+        super(MainWindow, self).hideEvent(event)
+        self.update_throttling()
+
+    def closeEvent(self, event):
+        ''' Stops every camera pair before the window closes and lets the recording finish writing. '''
+        for video_label in self.video_labels:
+            video_label.stop()
+        if self.recorder is not None:
+            self.recorder.stop(wait = True)
+        super(MainWindow, self).closeEvent(event)
+
+    def __init__(self, pairs = 1, frame_bus = None):
         ''' Main function where all the layout is determined. 
         '''
-        self.vi_connected = False
-        self.ter_connected = False
-
         super(MainWindow, self).__init__()
         self.setWindowTitle("Fusion")
-        apply_stylesheet(self, theme='dark_cyan.xml')
+        apply_theme(self, theme='dark_cyan.xml')
 
         # Create a central widget for the main window
         central_widget = QtWidgets.QWidget(self)
@@ -729,7 +1071,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.video_timer = QTimer(self)
         self.video_timer.timeout.connect(self.record_frame)
         self.recording = False
-        self.frames = []
+        self.recording_label = None
+        self.recorder = None
 
         # Create layouts for the main window
         main_layout = QtWidgets.QVBoxLayout()
@@ -740,7 +1083,7 @@ class MainWindow(QtWidgets.QMainWindow):
         other_info = QtWidgets.QVBoxLayout()
 
         # save_rec layout
-        self.video_label = VideoLabel(central_widget)
+        self.create_video_grid(central_widget, pairs, frame_bus)
         self.create_control_buttons(save_rec_layout)
 
         # other_info layout
@@ -761,22 +1104,28 @@ class MainWindow(QtWidgets.QMainWindow):
         other_info.addWidget(self.create_spacer(200, 20))
 
         other_info.addLayout(save_rec_layout)
-        other_info.addWidget(self.create_spacer(200, 20))
+        other_info.addWidget(self.create_spacer(200, 10))
+        self.create_playback_button(other_info)
+        other_info.addWidget(self.create_spacer(200, 10))
 
         self.theme_label(other_info, "COLOR THEME")
         self.choose_theme(other_info)
-        other_info.addWidget(self.create_spacer(200, 160))
+        other_info.addWidget(self.create_spacer(200, 10))
+
+        self.theme_label(other_info, "THERMAVUE THRESHOLD")
+        self.choose_threshold(other_info)
+        other_info.addWidget(self.create_spacer(200, 38))
        
         # Controls layout
         self.create_logo_label(controls_layout)
-        controls_layout.addWidget(self.create_spacer(200, 390))
+        controls_layout.addWidget(self.create_spacer(200, 39))
         self.create_buttons(controls_layout)
       
         # Top section
         top_layout.addWidget(self.create_spacer(5, 50))  
         top_layout.addLayout(other_info)
         top_layout.addWidget(self.create_spacer(5, 50))  
-        top_layout.addWidget(self.video_label)
+        top_layout.addLayout(self.video_grid)
         top_layout.addWidget(self.create_spacer(5, 50))  
         top_layout.addLayout(controls_layout)
         top_layout.addWidget(self.create_spacer(5, 50))
@@ -784,16 +1133,67 @@ class MainWindow(QtWidgets.QMainWindow):
         # Bottom section
         self.create_a_trackbar(bottom_layout)
         self.create_a_statusbar(bottom_layout)
+
+        # List the cameras in the background and fill the camera combo boxes once they are known
+        self.camera_enumerator = CameraEnumerator(self)
+        self.camera_enumerator.cameras_found.connect(self.fill_camera_combo_boxes)
+        self.camera_enumerator.start()
         
         # Main layout
-        main_layout.addWidget(self.create_spacer(100, 20))
+        main_layout.addWidget(self.create_spacer(100, 21))
         main_layout.addLayout(top_layout)
         main_layout.addLayout(bottom_layout)
         central_widget.setLayout(main_layout)
         self.setFixedSize(self.sizeHint())
 
+def report_startup_time(window):
+    ''' Prints how long it took until the window was ready and until the cameras were listed, then quits.
+    Used by the --startup-time option so the start up can be tracked over time.
+    '''
+    print(f"Window ready: {(time.perf_counter() - STARTUP_TIME) * 1000:.0f} ms", flush = True)
+    window.camera_enumerator.wait()
+    print(f"Cameras listed: {(time.perf_counter() - STARTUP_TIME) * 1000:.0f} ms", flush = True)
+    QApplication.quit()
+
+
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description = "Visible and thermal camera fusion.")
+    parser.add_argument("--pairs", type = int, default = 1, help = "number of thermal/visible camera pairs shown in a grid")
+    parser.add_argument("--frame-bus", nargs = "?", const = "fusion", metavar = "NAME",
+                        help = "publish the frames of every pair in shared memory as NAME0, NAME1, ... (default name: fusion)")
+    parser.add_argument("--record-size", metavar = "WIDTHxHEIGHT",
+                        help = "size of the recorded videos (default: the 640x480 of the fused frames, whatever the size of the view)")
+    parser.add_argument("--pre-record", type = float, default = 2, metavar = "SECONDS",
+                        help = "seconds kept before a thermal change in the On Change recording modes")
+    parser.add_argument("--post-record", type = float, default = 3, metavar = "SECONDS",
+                        help = "seconds kept after the last thermal change in the On Change recording modes")
+    parser.add_argument("--target-fps", type = int, default = 30, metavar = "FPS",
+                        help = "frame rate every pair holds by lowering its quality when it falls behind, 0 to always keep full quality")
+    parser.add_argument("--y16", action = "store_true",
+                        help = "read raw 16 bit frames (Y16) from the thermal cameras, for temperatures in the statistics")
+    parser.add_argument("--calibration", type = float, nargs = "+", default = [0.01, -273.15], metavar = "COEFFICIENT",
+                        help = "coefficients turning raw Y16 values into degrees Celsius, highest power first (default: 0.01 -273.15)")
+    parser.add_argument("--startup-time", action = "store_true", help = "print how long the start up takes and exit")
+    args, qt_args = parser.parse_known_args()
+    if args.record_size:
+        # recorder.py loads OpenCV, which the window otherwise only loads once the cameras are selected
+        from recorder import parse_size
+        try:
+            variables.record_size = parse_size(args.record_size)
+        except argparse.ArgumentTypeError as error:
+            parser.error(str(error))
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(args.pairs, args.frame_bus)
+    for video_label in window.video_labels:
+        video_label.settings.trigger_pre = args.pre_record
+        video_label.settings.trigger_post = args.post_record
+        video_label.settings.y16_flag = args.y16
+        video_label.settings.target_fps = args.target_fps
+        video_label.settings.thermal_calibration = args.calibration
     window.show()
+
+    if args.startup_time:
+        # The first event loop pass happens once the window has been shown and painted
+        QTimer.singleShot(0, lambda: report_startup_time(window))
     sys.exit(app.exec_())
@@ -0,0 +1,220 @@
+"""
+Description: in-app playback of the recorded videos. Every recording gets a small index file next to it
+(<name>.mp4.idx.json) with the wall clock time of every frame and regular seek points, so a seek goes
+straight to the nearest seek point before the wanted frame instead of decoding from the start.
+Thumbnails for the strip under the video are made on a background thread and kept in the user's cache
+folder, so opening the same recording again shows them at once.
+
+"""
+
+import os
+import json
+import time
+import bisect
+import hashlib
+import cv2
+from PyQt5 import QtWidgets, QtGui, QtCore
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from recorder import SEEK_INTERVAL, index_path
+
+THUMBNAIL_SIZE = (120, 90)
+THUMBNAIL_SPACING = 10  # seconds of video between two thumbnails
+
+
+class RecordingIndex:
+    def __init__(self, video_path, capture):
+        '''Loads the index of a recording. Recordings made before the index existed get one estimated from
+        the frame count and frame rate of the file.
+        '''
+        path = index_path(video_path)
+        if os.path.exists(path):
+            with open(path) as file:
+                index = json.load(file)
+            self.fps = index["fps"]
+            self.frames = index["frames"]
+            self.timestamps = index["timestamps"]
+            # Indexes written before the seek points were named call them key frames
+            self.seek_points = index.get("seek_points", index.get("keyframes"))
+        else:
+            self.fps = capture.get(cv2.CAP_PROP_FPS) or 24
+            self.frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            start = os.path.getmtime(video_path) - self.frames / self.fps
+            self.timestamps = [start + i / self.fps for i in range(self.frames)]
+            self.seek_points = list(range(0, self.frames, SEEK_INTERVAL))
+
+    def seek_point_before(self, frame):
+        '''Returns the last seek point at or before a frame.
+        '''
+        return self.seek_points[max(0, bisect.bisect_right(self.seek_points, frame) - 1)]
+
+
+class FrameReader:
+    def __init__(self, video_path):
+        '''Opens a recording together with its index.
+        '''
+        self.capture = cv2.VideoCapture(video_path)
+        self.index = RecordingIndex(video_path, self.capture)
+        self.position = 0  # the frame the decoder returns next
+
+    def read(self, frame):
+        '''Returns a frame of the recording. Moving forward inside the same group of pictures only decodes
+        the frames in between, anything else jumps to the seek point before the wanted frame first.
+        '''
+        frame = max(0, min(frame, self.index.frames - 1))
+        seek_point = self.index.seek_point_before(frame)
+        if not seek_point <= self.position <= frame:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, seek_point)
+            self.position = seek_point
+
+        while self.position < frame:
+            self.capture.grab()
+            self.position += 1
+
+        ret, image = self.capture.read()
+        self.position += 1
+        return image if ret else None
+
+    def release(self):
+        self.capture.release()
+
+
+class ThumbnailLoader(QThread):
+    thumbnail_ready = pyqtSignal(int, QtGui.QImage)
+
+    def __init__(self, video_path, frames, parent = None):
+        '''Makes the thumbnails of the given frames on a background thread. The frames should be seek points,
+        so each thumbnail is read with a single seek.
+        '''
+        super(ThumbnailLoader, self).__init__(parent)
+        self.video_path = video_path
+        self.frames = frames
+
+        stat = os.stat(video_path)
+        key = f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime}"
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+        self.cache = os.path.join(base, "fusion", "thumbnails", hashlib.sha1(key.encode()).hexdigest())
+
+    def run(self):
+        os.makedirs(self.cache, exist_ok = True)
+        capture = None
+        for frame in self.frames:
+            if self.isInterruptionRequested():
+                break
+            path = os.path.join(self.cache, f"{frame}.jpg")
+            if not os.path.exists(path):
+                if capture is None:
+                    capture = cv2.VideoCapture(self.video_path)
+                capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+                ret, image = capture.read()
+                if not ret:
+                    continue
+                cv2.imwrite(path, cv2.resize(image, THUMBNAIL_SIZE, interpolation = cv2.INTER_AREA))
+            self.thumbnail_ready.emit(frame, QtGui.QImage(path))
+        if capture is not None:
+            capture.release()
+
+
+class PlaybackWindow(QtWidgets.QDialog):
+    def __init__(self, video_path, parent = None):
+        ''' Sets up the playback window: the video, a play button, a slider over all frames and the thumbnail strip.
+        '''
+        super(PlaybackWindow, self).__init__(parent)
+        start = time.perf_counter()
+        self.setWindowTitle(os.path.basename(video_path))
+
+        self.reader = FrameReader(video_path)
+        self.index = self.reader.index
+
+        self.video_label = QtWidgets.QLabel()
+        self.video_label.setFixedSize(900, 680)
+        self.video_label.setAlignment(Qt.AlignCenter)
+
+        self.button_play = QtWidgets.QPushButton("Play")
+        self.button_play.setFixedSize(70, 30)
+        self.button_play.setCheckable(True)
+        self.button_play.clicked.connect(self.play_clicked)
+
+        self.slider = QtWidgets.QSlider(Qt.Horizontal)
+        self.slider.setRange(0, max(0, self.index.frames - 1))
+        self.slider.valueChanged.connect(self.show_frame)
+
+        self.time_label = QtWidgets.QLabel()
+        self.time_label.setFixedSize(200, 30)
+
+        self.thumbnails = QtWidgets.QListWidget()
+        self.thumbnails.setViewMode(QtWidgets.QListView.IconMode)
+        self.thumbnails.setFlow(QtWidgets.QListView.LeftToRight)
+        self.thumbnails.setWrapping(False)
+        self.thumbnails.setIconSize(QtCore.QSize(*THUMBNAIL_SIZE))
+        self.thumbnails.setFixedHeight(THUMBNAIL_SIZE[1] + 30)
+        self.thumbnails.itemClicked.connect(lambda item: self.slider.setValue(item.data(Qt.UserRole)))
+
+        self.status = QtWidgets.QLabel()
+
+        controls_layout = QtWidgets.QHBoxLayout()
+        controls_layout.addWidget(self.button_play)
+        controls_layout.addWidget(self.slider)
+        controls_layout.addWidget(self.time_label)
+
+        main_layout = QtWidgets.QVBoxLayout()
+        main_layout.addWidget(self.video_label)
+        main_layout.addLayout(controls_layout)
+        main_layout.addWidget(self.thumbnails)
+        main_layout.addWidget(self.status)
+        self.setLayout(main_layout)
+
+        self.play_timer = QtCore.QTimer(self)
+        self.play_timer.timeout.connect(self.next_frame)
+        self.finished.connect(self.stop)
+
+        # One thumbnail every few seconds of video, always on a seek point
+        step = max(1, round(THUMBNAIL_SPACING * self.index.fps / SEEK_INTERVAL))
+        self.loader = ThumbnailLoader(video_path, self.index.seek_points[::step], self)
+        self.loader.thumbnail_ready.connect(self.add_thumbnail)
+        self.loader.start()
+
+        self.show_frame(0)
+        self.status.setText(f"{self.index.frames} frames, opened in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def show_frame(self, frame):
+        ''' Displays a frame of the recording and the wall clock time it was recorded at. '''
+        image = self.reader.read(frame)
+        if image is None:
+            return
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        h, w, ch = rgb_image.shape
+        qt_image = QtGui.QImage(rgb_image.data, w, h, ch * w, QtGui.QImage.Format_RGB888)
+        self.video_label.setPixmap(QtGui.QPixmap.fromImage(qt_image.scaled(900, 680, Qt.KeepAspectRatio)))
+
+        if self.index.timestamps:
+            timestamp = self.index.timestamps[min(frame, len(self.index.timestamps) - 1)]
+            self.time_label.setText(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)))
+
+    def play_clicked(self):
+        ''' Play button callback function. Plays the recording at its own frame rate. '''
+        if self.button_play.isChecked():
+            self.play_timer.start(int(1000 / self.index.fps))
+            self.button_play.setText("Pause")
+        else:
+            self.play_timer.stop()
+            self.button_play.setText("Play")
+
+    def next_frame(self):
+        ''' Playback timer callback, moves to the next frame and stops at the end of the recording. '''
+        if self.slider.value() >= self.slider.maximum():
+            self.button_play.click()
+        else:
+            self.slider.setValue(self.slider.value() + 1)
+
+    def add_thumbnail(self, frame, image):
+        ''' Adds a thumbnail to the strip once the background thread has made it. '''
+        item = QtWidgets.QListWidgetItem(QtGui.QIcon(QtGui.QPixmap.fromImage(image)), "")
+        item.setData(Qt.UserRole, frame)
+        self.thumbnails.addItem(item)
+
+    def stop(self):
+        ''' Stops the playback and the thumbnail thread once the window is closed. '''
+        self.play_timer.stop()
+        self.loader.requestInterruption()
+        self.loader.wait()
+        self.reader.release()
@@ -0,0 +1,122 @@
+"""
+Description: video recording on its own thread. The recording is fed with the fused frames of the pipeline, before
+they are scaled for the view, so the video has the full resolution of the pipeline (or a size of its own) whatever
+the size of the window. Colour conversion, scaling and encoding happen on the recorder thread, the caller only
+hands over the frame. Every recording is closed with its frame index (<name>.mp4.idx.json), which the playback window
+reads to seek, so writing it does not need Qt.
+
+"""
+
+import json
+import queue
+import argparse
+import threading
+import cv2
+
+# Frames waiting for the encoder, about two seconds of video. Frames which come while it is full are dropped
+QUEUE_SIZE = 48
+# Frames between two seek points of the frame index. OpenCV does not tell where the encoder put its key frames, the
+# seek points only follow the group of pictures of 12 frames its FFmpeg writer is expected to use
+SEEK_INTERVAL = 12
+
+
+def parse_size(text):
+    '''Reads a video size given as WIDTHxHEIGHT, e.g. "1280x960", for the --record-size options.
+    '''
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text} is not a size like 1280x960")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"{text} is not a size like 1280x960")
+    return width, height
+
+
+def index_path(video_path):
+    return video_path + ".idx.json"
+
+
+def write_index(video_path, timestamps, fps, seek_interval = SEEK_INTERVAL):
+    '''Writes the frame index of a recording: the frame rate, the time of every frame and the seek points, the
+    frames where a seek starts decoding. The seek points are not read from the video, a seek to one of them still
+    lets the decoder find the key frame it needs.
+    '''
+    index = {
+        "fps": fps,
+        "frames": len(timestamps),
+        "timestamps": [round(t, 3) for t in timestamps],
+        "seek_points": list(range(0, len(timestamps), seek_interval)),
+    }
+    with open(index_path(video_path), "w") as file:
+        json.dump(index, file)
+
+
+class VideoRecorder:
+    def __init__(self, path, fps = 24, size = None):
+        '''Starts the recorder thread of one video. The video file is created with the first frame.
+        Input: path of the mp4 file, frame rate, and size (width, height) of the video, None for the size of the frames.
+        '''
+        self.path = path
+        self.fps = fps
+        self.size = size
+        self.frames = 0
+        self.dropped = 0
+        self.timestamps = []
+        self.stopped = False
+        self.stopping = threading.Event()
+        self.queue = queue.Queue(maxsize = QUEUE_SIZE)
+        self.thread = threading.Thread(target = self.run, name = "fusion-recorder", daemon = True)
+        self.thread.start()
+
+    def write(self, frame, timestamp):
+        '''Hands a fused frame (RGB, as made by the pipeline) to the recorder thread, without waiting for it.
+        The frame must not be changed afterwards, which holds for the fused frames of the pipeline.
+        '''
+        if self.stopped:
+            return
+        try:
+            self.queue.put_nowait((frame, timestamp))
+            self.frames += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        '''Runs on the recorder thread. Converts, scales and encodes the frames, then writes the frame index of
+        the video for the playback window.
+        '''
+        writer = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, timestamp = item
+            if writer is None:
+                size = self.size or (frame.shape[1], frame.shape[0])
+                writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, size)
+            if (frame.shape[1], frame.shape[0]) != size:
+                shrink = size[0] < frame.shape[1]
+                frame = cv2.resize(frame, size, interpolation = cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+            self.timestamps.append(timestamp)
+            # A stop which came while the queue was full could not queue its marker
+            if self.stopping.is_set() and self.queue.empty():
+                break
+
+        if writer is not None:
+            writer.release()
+            # The frame index lets the playback window seek without decoding the video from the start
+            write_index(self.path, self.timestamps, self.fps)
+
+    def stop(self, wait = False):
+        '''Ends the recording once the waiting frames are written. Returns at once unless wait is set, also while
+        the encoder is behind and the queue is full.
+        '''
+        if not self.stopped:
+            self.stopped = True
+            self.stopping.set()
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+        if wait:
+            self.thread.join()
@@ -0,0 +1,332 @@
+"""
+Description: headless mode. Runs the capture and fusion of one camera pair without any window, for a box with
+no monitor, and lets it be controlled over a small HTTP API on the local machine:
+
+    GET  /status             flags, opacity, cameras, recording state, statistics, warm objects and the metrics, as JSON
+    GET  /metrics            frame rate, frame time (with the camera wait), processing time, camera skew and stage times, as JSON
+    GET  /snapshot           the latest fused frame as a PNG image
+    GET  /spot?x=320&y=240   the temperature in degrees Celsius at a point of the 640x480 thermal frame, with --y16
+    POST /settings           JSON object with the flags and values to change, e.g. {"map_flag": true, "opacity": 70}
+    POST /snapshot           saves the latest fused frame to the save folder, returns the path
+    POST /record/start       starts recording to the save folder, only while the thermal scene changes if
+                             trigger_flag is set (with trigger_sensitivity, trigger_pre and trigger_post seconds)
+    POST /record/stop        stops recording, returns the path of the video
+
+Example: "python service.py --termo 0 --visible 1 --folder recordings", then
+"curl -X POST -d '{"vue_flag": true}' localhost:8765/settings".
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import cv2
+import variables
+from fusion import FusionPipeline, THRESHOLD_MODES, WARMUP_FRAMES
+from analytics import ChangeGate
+from recorder import VideoRecorder, parse_size
+
+RECORD_FPS = 24
+
+# The settings which can be changed over the API and their types
+SETTINGS = {
+    "termo_flag": bool,
+    "visible_flag": bool,
+    "map_flag": bool,
+    "vue_flag": bool,
+    "luma_flag": bool,
+    "pyramid_flag": bool,
+    "stats_flag": bool,
+    "objects_flag": bool,
+    "agc_flag": bool,
+    "threshold_mode": str,
+    "trigger_flag": bool,
+    "trigger_sensitivity": int,
+    "trigger_pre": float,
+    "trigger_post": float,
+    "opacity": int,
+    "target_fps": int,
+    "termo": int,
+    "visible": int,
+}
+
+
+class FusionService:
+    def __init__(self, settings, folder = None, file_name = None, record_size = None):
+        '''Initialises the service of one camera pair. The settings hold the flags of the pair, like in the window.
+        Recordings have the size of the fused frames unless a record_size (width, height) is given.
+        '''
+        self.settings = settings
+        self.folder = folder
+        self.file_name = file_name
+        self.record_size = record_size
+        self.pipeline = FusionPipeline(settings)
+        self.frame = None
+        self.running = False
+        self.thread = None
+
+        self.frames = 0
+        self.fps = 0.0
+        # Averages in milliseconds of a whole frame (including the wait for the cameras) and of its processing alone
+        self.frame_time = 0.0
+        self.process_time = 0.0
+
+        # The processing thread hands the frames to the recorder thread, the API only asks for it to start and stop
+        self.record_lock = threading.Lock()
+        self.recorder = None
+        self.next_record_time = 0.0
+        self.change_gate = None
+
+    def start(self):
+        '''Connects to the cameras, lets them settle and starts processing on a background thread.
+        '''
+        self.pipeline.connectToCameras(WARMUP_FRAMES, lambda message: print(message, flush = True))
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = "fusion-service", daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.stop_recording()
+        self.pipeline.release()
+
+    def run(self):
+        '''Processing loop. Runs as fast as the cameras deliver frames, nothing is drawn.
+        '''
+        last = time.perf_counter()
+        while self.running:
+            start = time.perf_counter()
+            ret1, ret2, fusedFrame = self.pipeline.process_frame()
+            if fusedFrame is None:
+                # A camera is being reconnected in the background
+                time.sleep(0.01)
+                continue
+
+            now = time.perf_counter()
+            self.frame_time += 0.1 * ((now - start) * 1000 - self.frame_time)
+            self.process_time += 0.1 * (self.pipeline.process_time - self.process_time)
+            self.fps += 0.1 * (1 / max(now - last, 1e-6) - self.fps)
+            last = now
+            self.frames += 1
+            self.frame = fusedFrame
+            self.record_frame(fusedFrame)
+
+    def file_path(self, default_name, extension):
+        '''Returns a new file path in the save folder, named like the files saved from the window.
+        '''
+        random_string = ''.join(random.choice(string.digits) for _ in range(4))
+        file_name = (self.file_name or default_name) + "_" + random_string
+        return os.path.join(self.folder, f"{file_name}.{extension}")
+
+    def snapshot(self):
+        '''Returns the latest fused frame as PNG data, in the colours of the live view.
+        '''
+        if self.frame is None:
+            return None
+        return cv2.imencode(".png", cv2.cvtColor(self.frame, cv2.COLOR_RGB2BGR))[1].tobytes()
+
+    def save_snapshot(self):
+        png = self.snapshot()
+        if png is None:
+            raise RuntimeError("No frame yet")
+        path = self.file_path("fusionCapture", "png")
+        with open(path, "wb") as file:
+            file.write(png)
+        return path
+
+    def start_recording(self):
+        with self.record_lock:
+            if self.recorder is None:
+                self.next_record_time = time.time()
+                self.change_gate = ChangeGate(self.settings.trigger_pre, self.settings.trigger_post, RECORD_FPS)
+                self.recorder = VideoRecorder(self.file_path("fusionVideoCapture", "mp4"), RECORD_FPS, self.record_size)
+            return self.recorder.path
+
+    def record_frame(self, fusedFrame):
+        '''Records the latest frame at the frame rate of the recording, like the window which records 24 times per second.
+        '''
+        with self.record_lock:
+            now = time.time()
+            if self.recorder is None or now < self.next_record_time:
+                return
+            if self.settings.trigger_flag:
+                # Nothing is encoded or written while the thermal scene does not change
+                kept = self.change_gate.push(fusedFrame, now, self.settings.last_change)
+            else:
+                kept = [(fusedFrame, now)]
+            for frame, timestamp in kept:
+                self.recorder.write(frame, timestamp)
+            self.next_record_time = max(self.next_record_time + 1 / RECORD_FPS, now - 1 / RECORD_FPS)
+
+    def stop_recording(self):
+        with self.record_lock:
+            if self.recorder is None:
+                return None
+            recorder, self.recorder = self.recorder, None
+        # The video is complete once the recorder thread has written the waiting frames and the frame index
+        recorder.stop(wait = True)
+        return recorder.path
+
+    def update_settings(self, values):
+        '''Changes the flags and values given in a dictionary. Unknown names and wrong types are refused.
+        '''
+        for name, value in values.items():
+            if name not in SETTINGS:
+                raise ValueError(f"Unknown setting {name}")
+            # JSON has one number type, whole numbers are taken for the settings in seconds too
+            if SETTINGS[name] is float and type(value) is int:
+                value = values[name] = float(value)
+            if type(value) is not SETTINGS[name]:
+                raise ValueError(f"{name} must be of type {SETTINGS[name].__name__}")
+            if name == "threshold_mode" and value not in THRESHOLD_MODES:
+                raise ValueError(f"threshold_mode must be one of {', '.join(THRESHOLD_MODES)}")
+            if name in ("opacity", "trigger_sensitivity") and not 0 <= value <= 100:
+                raise ValueError(f"{name} must be between 0 and 100")
+            if name in ("trigger_pre", "trigger_post", "target_fps", "termo", "visible") and value < 0:
+                raise ValueError(f"{name} can not be negative")
+        for name, value in values.items():
+            setattr(self.settings, name, value)
+
+    def metrics(self):
+        settings = self.settings
+        return {
+            "frames": self.frames,
+            "fps": round(self.fps, 1),
+            "frame_ms": round(self.frame_time, 2),
+            "process_ms": round(self.process_time, 2),
+            "skew_ms": {name: round(value, 2) for name, value in settings.skew._asdict().items()} if settings.skew else None,
+            "stage_ms": {name: round(value, 2) for name, value in (settings.stage_times or {}).items()},
+        }
+
+    def status(self):
+        settings = self.settings
+        status = {name: getattr(settings, name) for name in SETTINGS}
+        status["threshold"] = settings.threshold
+        status["quality"] = settings.quality
+        status["camera_status"] = self.pipeline.camera_status
+        status["recording"] = self.recorder is not None
+        status["stats"] = settings.stats._asdict() if settings.stats_flag and settings.stats else None
+        status["objects"] = [warm_object._asdict() for warm_object in settings.objects or []] if settings.objects_flag else None
+        status["metrics"] = self.metrics()
+        return status
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send(self, code, body, content_type = "application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Routes are matched on the path alone, a query string does not change the route
+        url = urlsplit(self.path)
+        if url.path == "/status":
+            self.send(200, self.service.status())
+        elif url.path == "/metrics":
+            self.send(200, self.service.metrics())
+        elif url.path == "/snapshot":
+            png = self.service.snapshot()
+            if png is None:
+                self.send(503, {"error": "No frame yet"})
+            else:
+                self.send(200, png, "image/png")
+        elif url.path == "/spot":
+            self.spot(parse_qs(url.query))
+        else:
+            self.send(404, {"error": "Not found"})
+
+    def spot(self, query):
+        try:
+            x, y = int(query["x"][0]), int(query["y"][0])
+        except (KeyError, ValueError):
+            self.send(400, {"error": "Give the point as /spot?x=320&y=240"})
+            return
+        if not (0 <= x < 640 and 0 <= y < 480):
+            self.send(400, {"error": "The point must lie in the 640x480 thermal frame"})
+            return
+        temperature = self.service.pipeline.spotTemperature(x, y)
+        if temperature is None:
+            self.send(409, {"error": "No raw thermal frame, start the service with --y16"})
+        else:
+            self.send(200, {"x": x, "y": y, "celsius": round(temperature, 2)})
+
+    def do_POST(self):
+        service = self.service
+        path = urlsplit(self.path).path
+        try:
+            if path == "/settings":
+                length = int(self.headers.get("Content-Length", 0))
+                values = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(values, dict):
+                    raise ValueError("Expected a JSON object")
+                service.update_settings(values)
+                self.send(200, service.status())
+            elif path in ("/snapshot", "/record/start") and service.folder is None:
+                self.send(409, {"error": "No save folder, start the service with --folder"})
+            elif path == "/snapshot":
+                self.send(200, {"path": service.save_snapshot()})
+            elif path == "/record/start":
+                self.send(200, {"path": service.start_recording()})
+            elif path == "/record/stop":
+                self.send(200, {"path": service.stop_recording()})
+            else:
+                self.send(404, {"error": "Not found"})
+        except (ValueError, RuntimeError) as error:
+            self.send(400, {"error": str(error)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Visible and thermal camera fusion without a window, controlled over HTTP.")
+    parser.add_argument("--termo", type = int, required = True, help = "index of the thermal camera")
+    parser.add_argument("--visible", type = int, required = True, help = "index of the visible camera")
+    parser.add_argument("--folder", help = "folder for snapshots and recordings")
+    parser.add_argument("--file-name", help = "file name prefix of snapshots and recordings")
+    parser.add_argument("--record-size", type = parse_size, metavar = "WIDTHxHEIGHT", help = "size of the recorded videos (default: 640x480)")
+    parser.add_argument("--host", default = "127.0.0.1", help = "address to listen on (default: this machine only)")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--frame-bus", metavar = "NAME", help = "publish the frames in shared memory under this name (see framebus.py)")
+    parser.add_argument("--target-fps", type = int, default = 30, metavar = "FPS",
+                        help = "frame rate held by lowering the quality when the processing falls behind, 0 to always keep full quality")
+    parser.add_argument("--y16", action = "store_true", help = "read raw 16 bit frames (Y16) from the thermal camera, for temperatures")
+    parser.add_argument("--calibration", type = float, nargs = "+", default = [0.01, -273.15], metavar = "COEFFICIENT",
+                        help = "coefficients turning raw Y16 values into degrees Celsius, highest power first (default: 0.01 -273.15)")
+    args = parser.parse_args()
+
+    settings = variables.PairSettings()
+    settings.termo = args.termo
+    settings.visible = args.visible
+    settings.frame_bus = args.frame_bus
+    settings.y16_flag = args.y16
+    settings.target_fps = args.target_fps
+    settings.thermal_calibration = args.calibration
+
+    service = FusionService(settings, args.folder, args.file_name, args.record_size)
+    service.start()
+    RequestHandler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print(f"Fusion service listening on http://{args.host}:{args.port}", flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.stop()
+    sys.exit(0)
@@ -0,0 +1,352 @@
+"""
+Description: soak test. Runs the whole window (capture, fusion, display and recording) for hours under the Qt
+offscreen platform, fed by synthetic cameras or by looped video files instead of camera devices, and checks that
+it stays fast and does not leak:
+
+    latency     time from the moment a frame is taken by the (synthetic) camera until it is on the video label,
+                followed for every frame by its frame number; reported as percentiles
+    dropped     camera frames which never reached the video label
+    memory      growth of the resident memory (RSS) and of the Python allocations (tracemalloc) after the warm-up
+
+Recordings are started and stopped from time to time with the Rec button, into a temporary folder.
+The run fails (exit code 1) when a limit is exceeded.
+
+Example: "python soak.py --hours 8 --pairs 2 --color-map --statistics", or with recorded footage
+"python soak.py --visible-file visible.mp4 --thermal-file thermal.mp4".
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import cv2
+import numpy as np
+
+# Indices of the soak sources, above the indices of real camera devices
+SOURCE_INDEX = 1000
+
+# Latency histogram: 0.5 ms bins up to 5 s, so hours of frames take no more memory than a few seconds
+LATENCY_BIN = 0.5
+LATENCY_BINS = 10000
+
+
+class PacedSource:
+    '''A camera which delivers frames at a fixed rate, like a device: grab() waits for the next frame and frames
+    which were not grabbed in time are lost. Frame n is taken at start + n / fps, which is the start of its latency.
+    '''
+    def __init__(self, fps, start):
+        self.fps = fps
+        self.start = start
+        self.frame_id = -1
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        next_id = max(self.frame_id + 1, int((time.perf_counter() - self.start) * self.fps))
+        delay = self.start + next_id / self.fps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.frame_id = next_id
+        return self.opened
+
+    def retrieve(self):
+        return True, self.render(self.frame_id)
+
+    def taken_at(self, frame_id):
+        return self.start + frame_id / self.fps
+
+    def release(self):
+        self.opened = False
+
+
+class SyntheticSource(PacedSource):
+    def __init__(self, fps, start, thermal, seed = 0):
+        '''A camera which shows a moving warm object over a textured background, with a little sensor noise.
+        The thermal camera delivers grey frames in three channels, like OpenCV does for real thermal cameras.
+        '''
+        super(SyntheticSource, self).__init__(fps, start)
+        self.thermal = thermal
+        rng = np.random.default_rng(seed)
+        y, x = np.mgrid[0:480, 0:640]
+        if thermal:
+            background = (60 + 40 * y / 480 + rng.integers(0, 8, (480, 640))).astype(np.uint8)
+            self.background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+        else:
+            self.background = np.dstack([(x * 255 // 640), (y * 255 // 480), rng.integers(0, 255, (480, 640))]).astype(np.uint8)
+        self.noise = [rng.integers(0, 6, (480, 640, 3), dtype = np.uint8) for _ in range(8)]
+
+    def render(self, frame_id):
+        frame = cv2.add(self.background, self.noise[frame_id % len(self.noise)])
+        x = int(320 + 240 * np.sin(frame_id / (4 * self.fps)))
+        y = int(240 + 160 * np.cos(frame_id / (6 * self.fps)))
+        colour = (230, 230, 230) if self.thermal else (40, 90, 200)
+        cv2.circle(frame, (x, y), 40, colour, -1)
+        return frame
+
+
+class FileSource(PacedSource):
+    def __init__(self, fps, start, path):
+        '''A camera which plays a video file in a loop.
+        '''
+        super(FileSource, self).__init__(fps, start)
+        self.capture = cv2.VideoCapture(path)
+        self.opened = self.capture.isOpened()
+
+    def render(self, frame_id):
+        ret, frame = self.capture.read()
+        if not ret:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        return frame
+
+    def release(self):
+        super(FileSource, self).release()
+        self.capture.release()
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = np.zeros(LATENCY_BINS, np.int64)
+
+    def add(self, latency):
+        self.counts[min(int(latency / LATENCY_BIN), LATENCY_BINS - 1)] += 1
+
+    def percentile(self, percent):
+        total = self.counts.sum()
+        if total == 0:
+            return None
+        return (np.searchsorted(np.cumsum(self.counts), total * percent / 100) + 1) * LATENCY_BIN
+
+
+def rss_mb():
+    '''Returns the resident memory of the process in MB, None where /proc is not available.
+    '''
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+class Soak:
+    def __init__(self, args):
+        '''Prepares the sources of every pair and the measurements. The window is made in run().
+        '''
+        self.args = args
+        self.sources = {}
+        self.taken = {}
+        self.histogram = LatencyHistogram()
+        self.interval_histogram = LatencyHistogram()
+        # Per pair: first and last frame number shown and how many frames were shown
+        self.first_id = {}
+        self.last_id = {}
+        self.shown = {}
+        self.memory = []
+        self.failures = []
+
+    def make_source(self, index):
+        args = self.args
+        thermal = (index - SOURCE_INDEX) % 2 == 0
+        path = args.thermal_file if thermal else args.visible_file
+        if path:
+            source = FileSource(args.fps, self.start, path)
+        else:
+            source = SyntheticSource(args.fps, self.start, thermal, seed = index)
+        self.sources[index] = source
+        return source
+
+    def trace(self, process_frame):
+        '''Wraps FusionPipeline.process_frame to note the frame number behind every fused frame.
+        '''
+        def traced(pipeline):
+            ret1, ret2, fusedFrame = process_frame(pipeline)
+            if fusedFrame is not None:
+                source = pipeline.visibleCamera
+                self.taken[id(fusedFrame)] = (pipeline, source.frame_id, source.taken_at(source.frame_id))
+            return ret1, ret2, fusedFrame
+        return traced
+
+    def frame_shown(self, fusedFrame):
+        '''Runs on the GUI thread after the video label has shown a frame.
+        '''
+        if fusedFrame is None:
+            return
+        now = time.perf_counter()
+        traced = self.taken.pop(id(fusedFrame), None)
+        if traced is None:
+            return
+        pipeline, frame_id, taken_at = traced
+        if now - self.start < self.args.warmup:
+            return
+        latency = (now - taken_at) * 1000
+        self.histogram.add(latency)
+        self.interval_histogram.add(latency)
+        self.first_id.setdefault(pipeline, frame_id)
+        self.last_id[pipeline] = frame_id
+        self.shown[pipeline] = self.shown.get(pipeline, 0) + 1
+
+    def dropped(self):
+        expected = sum(self.last_id[pipeline] - self.first_id[pipeline] + 1 for pipeline in self.last_id)
+        shown = sum(self.shown.values())
+        return expected - shown, expected
+
+    def close_message_boxes(self):
+        '''The window confirms a saved recording with a message box, which nobody clicks here.
+        '''
+        from PyQt5.QtWidgets import QApplication
+        widget = QApplication.activeModalWidget()
+        if widget is not None:
+            widget.close()
+
+    def cycle_recording(self):
+        '''Starts a recording every record_every seconds and stops it after record_length seconds.
+        '''
+        args = self.args
+        window = self.window
+        elapsed = time.perf_counter() - self.start
+        if args.record_every <= 0:
+            return
+        recording = elapsed % args.record_every < args.record_length
+        if recording != window.button_record.isChecked():
+            window.button_record.setChecked(recording)
+            window.toggle_video_recording()
+            if not recording:
+                for name in os.listdir(self.folder):
+                    os.remove(os.path.join(self.folder, name))
+
+    def report(self):
+        args = self.args
+        elapsed = time.perf_counter() - self.start
+        tracemalloc_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20 if tracemalloc.is_tracing() else None
+        rss = rss_mb()
+        # Memory is compared between moments without a recording, whose frames are held until it stops
+        if elapsed >= args.warmup and not self.window.button_record.isChecked():
+            self.memory.append((rss, tracemalloc_mb))
+
+        histogram = self.interval_histogram
+        latency = " ".join(f"p{percent} {histogram.percentile(percent) or 0:.1f}" for percent in (50, 95, 99))
+        dropped, expected = self.dropped()
+        memory = f"rss {rss:.0f} MB" if rss is not None else "rss -"
+        if tracemalloc_mb is not None:
+            memory += f"  traced {tracemalloc_mb:.1f} MB"
+        print(f"[{elapsed / 60:6.1f} min] latency ms {latency}  dropped {dropped}/{expected}  {memory}", flush = True)
+        self.interval_histogram = LatencyHistogram()
+
+        if elapsed >= args.hours * 3600:
+            self.finish()
+
+    def finish(self):
+        from PyQt5.QtWidgets import QApplication
+        args = self.args
+        if self.window.button_record.isChecked():
+            self.window.button_record.setChecked(False)
+            self.window.toggle_video_recording()
+
+        p50, p95, p99 = (self.histogram.percentile(percent) for percent in (50, 95, 99))
+        dropped, expected = self.dropped()
+        print(f"Latency ms: p50 {p50}  p95 {p95}  p99 {p99}")
+        print(f"Dropped frames: {dropped} of {expected}")
+        if p99 is None:
+            self.failures.append("no frame was shown")
+        elif p99 > args.max_p99:
+            self.failures.append(f"p99 latency {p99:.1f} ms is over {args.max_p99} ms")
+        if expected and dropped / expected > args.max_dropped:
+            self.failures.append(f"{dropped / expected:.1%} of the frames were dropped, the limit is {args.max_dropped:.1%}")
+
+        if len(self.memory) >= 2:
+            (rss_start, traced_start), (rss_end, traced_end) = self.memory[0], self.memory[-1]
+            if rss_start is not None:
+                print(f"RSS growth: {rss_end - rss_start:.1f} MB")
+                if rss_end - rss_start > args.max_rss_growth:
+                    self.failures.append(f"RSS grew by {rss_end - rss_start:.1f} MB, the limit is {args.max_rss_growth} MB")
+            if traced_start is not None:
+                print(f"tracemalloc growth: {traced_end - traced_start:.1f} MB")
+                if traced_end - traced_start > args.max_traced_growth:
+                    self.failures.append(f"Python allocations grew by {traced_end - traced_start:.1f} MB, the limit is {args.max_traced_growth} MB")
+
+        print("FAIL: " + "; ".join(self.failures) if self.failures else "PASS", flush = True)
+        QApplication.quit()
+
+    def run(self):
+        args = self.args
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt5 import QtWidgets, QtCore
+        import variables
+        import fusion
+        import main
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        app = QtWidgets.QApplication(sys.argv[:1])
+        self.start = time.perf_counter()
+        for index in range(SOURCE_INDEX, SOURCE_INDEX + 2 * args.pairs):
+            fusion.register_source(index, lambda index = index: self.make_source(index))
+        fusion.FusionPipeline.process_frame = self.trace(fusion.FusionPipeline.process_frame)
+
+        self.folder = tempfile.mkdtemp(prefix = "fusion-soak-")
+        variables.folder = self.folder
+        self.window = window = main.MainWindow(args.pairs)
+        for idx, video_label in enumerate(window.video_labels):
+            settings = video_label.settings
+            settings.termo = SOURCE_INDEX + 2 * idx
+            settings.visible = SOURCE_INDEX + 2 * idx + 1
+            settings.termo_flag = args.contour_thermo
+            settings.visible_flag = args.contour_visible
+            settings.map_flag = args.color_map
+            settings.vue_flag = args.thermavue
+            settings.luma_flag = args.luminance
+            settings.pyramid_flag = args.pyramid
+            settings.stats_flag = args.statistics
+            settings.objects_flag = args.objects
+            settings.agc_flag = args.auto_gain
+            video_label.frame_ready.connect(lambda ret1, ret2, fusedFrame, viewFrame: self.frame_shown(fusedFrame))
+        window.show()
+
+        timers = []
+        for interval, callback in ((500, self.close_message_boxes), (1000, self.cycle_recording), (args.report_every * 1000, self.report)):
+            timer = QtCore.QTimer()
+            timer.timeout.connect(callback)
+            timer.start(int(interval))
+            timers.append(timer)
+
+        print(f"Soak test: {args.pairs} pair(s) at {args.fps} fps for {args.hours} h, warm-up {args.warmup} s", flush = True)
+        app.exec_()
+        for video_label in window.video_labels:
+            video_label.stop()
+        shutil.rmtree(self.folder, ignore_errors = True)
+        return not self.failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Soak test of the whole window with synthetic or recorded cameras.")
+    parser.add_argument("--hours", type = float, default = 1)
+    parser.add_argument("--pairs", type = int, default = 1)
+    parser.add_argument("--fps", type = float, default = 30, help = "frame rate of the sources")
+    parser.add_argument("--visible-file", help = "video played in a loop by the visible cameras instead of synthetic frames")
+    parser.add_argument("--thermal-file", help = "video played in a loop by the thermal cameras instead of synthetic frames")
+    parser.add_argument("--contour-thermo", action = "store_true")
+    parser.add_argument("--contour-visible", action = "store_true")
+    parser.add_argument("--color-map", action = "store_true")
+    parser.add_argument("--thermavue", action = "store_true")
+    parser.add_argument("--luminance", action = "store_true")
+    parser.add_argument("--pyramid", action = "store_true")
+    parser.add_argument("--statistics", action = "store_true")
+    parser.add_argument("--objects", action = "store_true")
+    parser.add_argument("--auto-gain", action = "store_true")
+    parser.add_argument("--record-every", type = float, default = 600, help = "seconds between the starts of two recordings, 0 for none")
+    parser.add_argument("--record-length", type = float, default = 60, help = "seconds every recording lasts")
+    parser.add_argument("--warmup", type = float, default = 30, help = "seconds before measuring starts")
+    parser.add_argument("--report-every", type = float, default = 60, help = "seconds between two progress lines")
+    parser.add_argument("--no-tracemalloc", dest = "tracemalloc", action = "store_false", help = "do not trace the Python allocations, which slows the run down")
+    parser.add_argument("--max-p99", type = float, default = 150, help = "limit of the 99th percentile latency in ms")
+    parser.add_argument("--max-dropped", type = float, default = 0.1, help = "limit of the dropped frames, as a fraction")
+    parser.add_argument("--max-rss-growth", type = float, default = 64, help = "limit of the RSS growth in MB")
+    parser.add_argument("--max-traced-growth", type = float, default = 16, help = "limit of the growth of the Python allocations in MB")
+    args = parser.parse_args()
+    sys.exit(0 if Soak(args).run() else 1)
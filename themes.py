@@ -0,0 +1,117 @@
+"""
+Description: colour themes for the interface. qt_material renders a theme by running a jinja template and
+writing a full set of recoloured icons, which takes longer than building the whole window. The rendered
+stylesheet and icons are therefore kept on disk per theme, so a theme is only rendered once per installed
+qt_material version, and qt_material itself is only imported when a theme has not been rendered yet.
+
+Run "python themes.py" to render every theme in advance.
+
+"""
+
+import os
+import sys
+import json
+import importlib.util
+from importlib import metadata
+from PyQt5 import QtGui, QtCore
+
+THEMES = ['dark_amber.xml', 'dark_blue.xml', 'dark_cyan.xml', 'dark_lightgreen.xml', 'dark_pink.xml',
+          'dark_purple.xml', 'dark_red.xml', 'dark_teal.xml', 'dark_yellow.xml', 'light_amber.xml',
+          'light_blue.xml', 'light_cyan.xml', 'light_lightgreen.xml', 'light_pink.xml', 'light_purple.xml',
+          'light_red.xml', 'light_teal.xml', 'light_yellow.xml']
+
+# Themes which have already been read from disk during this run
+_stylesheets = {}
+_fonts_added = False
+
+
+def cache_folder():
+    '''Returns the folder where the rendered themes are kept. A new qt_material version gets a new folder.
+    '''
+    try:
+        version = metadata.version("qt-material")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "fusion", "themes", version)
+
+
+def qt_material_folder():
+    '''Finds the qt_material package folder without importing the package.
+    '''
+    spec = importlib.util.find_spec("qt_material")
+    return list(spec.submodule_search_locations)[0]
+
+
+def add_fonts():
+    '''Registers the Roboto fonts used by the stylesheets. Only done once per run.
+    '''
+    global _fonts_added
+    if _fonts_added:
+        return
+    fonts_path = os.path.join(qt_material_folder(), "fonts", "roboto")
+    for font in os.listdir(fonts_path):
+        if font.endswith(".ttf"):
+            QtGui.QFontDatabase.addApplicationFont(os.path.join(fonts_path, font))
+    _fonts_added = True
+
+
+def render_theme(theme, folder):
+    '''Renders a theme with qt_material into the folder: the recoloured icons, stylesheet.qss and theme.json.
+    '''
+    from qt_material import build_stylesheet, get_theme
+
+    # export = True leaves the fonts out, apply_theme registers them itself
+    stylesheet = build_stylesheet(theme, parent = folder, export = True)
+    colors = get_theme(theme)
+    with open(os.path.join(folder, "stylesheet.qss"), "w") as file:
+        file.write(stylesheet)
+    with open(os.path.join(folder, "theme.json"), "w") as file:
+        json.dump({"primaryColor": colors["primaryColor"]}, file)
+
+
+def load_theme(theme):
+    '''Returns the stylesheet, the primary colour and the icon folder of a theme, rendering it first if it
+    is not on disk yet.
+    '''
+    if theme in _stylesheets:
+        return _stylesheets[theme]
+
+    folder = os.path.join(cache_folder(), os.path.splitext(theme)[0])
+    if not os.path.exists(os.path.join(folder, "theme.json")):
+        os.makedirs(folder, exist_ok = True)
+        render_theme(theme, folder)
+
+    with open(os.path.join(folder, "stylesheet.qss")) as file:
+        stylesheet = file.read()
+    with open(os.path.join(folder, "theme.json")) as file:
+        primary = json.load(file)["primaryColor"]
+
+    _stylesheets[theme] = (stylesheet, primary, folder)
+    return _stylesheets[theme]
+
+
+def apply_theme(widget, theme):
+    '''Applies a theme to a widget, the same way qt_material.apply_stylesheet does, but from the cache.
+    '''
+    stylesheet, primary, folder = load_theme(theme)
+    add_fonts()
+
+    # The stylesheet refers to the icons as icon:/primary/..., so only this theme's folder may be searched
+    QtCore.QDir.setSearchPaths("icon", [folder])
+
+    palette = QtGui.QGuiApplication.palette()
+    color = QtGui.QColor(*[int(primary[i : i + 2], 16) for i in range(1, 6, 2)] + [92])
+    palette.setColor(QtGui.QPalette.Text, color)
+    QtGui.QGuiApplication.setPalette(palette)
+
+    widget.setStyleSheet(stylesheet)
+
+
+if __name__ == '__main__':
+    from PyQt5 import QtWidgets
+    app = QtWidgets.QApplication(sys.argv)
+    for theme in THEMES:
+        load_theme(theme)
+        print(f"Rendered {theme}")
+    print(f"Themes are saved in {cache_folder()}")
@@ -1,17 +1,70 @@
-opacity = 50
-termo_flag = False
-vue_flag =  False
-visible_flag = False
-map_flag = False
+import sys
+import copy
+
+# Flags and values of one camera pair, with their defaults. The first pair uses the variables of this module, every
+# further pair a PairSettings object; both are filled from this table, so a new setting is only added here.
+PAIR_DEFAULTS = {
+    "opacity": 50,
+    "termo_flag": False,
+    "vue_flag": False,
+    "luma_flag": False,
+    "pyramid_flag": False,
+    "visible_flag": False,
+    "map_flag": False,
+    "picture": None,
+    "frame": None,
+    "termo": None,
+    "visible": None,
+    "stats_flag": False,
+    "stats_log": None,
+    "stats": None,
+    "objects_flag": False,
+    "objects_log": None,
+    "objects": None,
+    "agc_flag": False,
+    "threshold_mode": "Fixed",
+    "threshold": 100,
+    "skew": None,
+    "stage_times": None,
+    "frame_bus": None,
+    "views": ["fused"],
+    "trigger_flag": False,
+    "trigger_sensitivity": 50,
+    "trigger_pre": 2,
+    "trigger_post": 3,
+    "last_change": 0.0,
+    "target_fps": 30,
+    "quality": "Full",
+    "y16_flag": False,
+    "thermal_calibration": [0.01, -273.15],
+}
+
+
+def apply_defaults(settings):
+    ''' Sets the flags and values of a camera pair to their defaults. Lists are copied, so pairs never share one.
+    '''
+    for name, value in PAIR_DEFAULTS.items():
+        setattr(settings, name, copy.deepcopy(value))
+
+
+class PairSettings:
+    ''' Flags and values of one camera pair. The first pair uses this module directly, every further pair
+    in the window gets one of these objects, which holds the same names.
+    '''
+    def __init__(self):
+        apply_defaults(self)
+
+
+# Values of the whole window
 record =  False
 qt_img = None
 folder = None
 file_name = None
-picture = None
-termo = None
-visible = None
+record_size = None
 start = False
 
+apply_defaults(sys.modules[__name__])
+
 
 
 